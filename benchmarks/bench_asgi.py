@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Compare the ASGI plugin with the WSGI one running under a thread pool, on
+concurrent login requests whose bodies arrive slowly::
+
+    python benchmarks/bench_asgi.py [--concurrency 10,100,1000] [--threads 32]
+
+Each body is sent in two chunks, with ``--latency`` milliseconds before each
+one. The WSGI plugin blocks a thread of the pool while it waits for them,
+and the ASGI one only suspends a coroutine.
+
+"""
+from __future__ import print_function
+
+import asyncio
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from repoze.who.plugins.friendlyform.asgi import AsyncFriendlyFormPlugin
+
+import environs
+
+_CHUNKS = (b'login=gustavo&pass', b'word=secret&remember=3600')
+
+_HEADERS = [(b'host', b'example.org'),
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(b''.join(_CHUNKS))).encode('ascii'))]
+
+
+class SlowInput(object):
+    """WSGI input which waits ``latency`` seconds before each chunk."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.chunks = list(_CHUNKS)
+
+    def read(self, size=-1):
+        if not self.chunks:
+            return b''
+        time.sleep(self.latency)
+        return self.chunks.pop(0)
+
+
+def make_wsgi_environ(latency):
+    environ = environs.make_environ('/login_handler')
+    environ['REQUEST_METHOD'] = 'POST'
+    environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    environ['CONTENT_LENGTH'] = str(len(b''.join(_CHUNKS)))
+    environ['wsgi.input'] = SlowInput(latency)
+    return environ
+
+
+async def run_wsgi(concurrency, requests, threads, latency):
+    plugin = environs.make_plugin('/welcome')
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(threads) as executor:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with semaphore:
+                await loop.run_in_executor(executor, plugin.identify,
+                                           make_wsgi_environ(latency))
+
+        start = perf_counter()
+        await asyncio.gather(*[request() for i in range(requests)])
+        return requests / (perf_counter() - start)
+
+
+async def run_asgi(concurrency, requests, latency):
+    plugin = AsyncFriendlyFormPlugin(environs.make_plugin('/welcome'))
+    scope = {'type': 'http', 'method': 'POST', 'path': '/login_handler',
+             'root_path': '', 'query_string': b'', 'scheme': 'http',
+             'server': ('example.org', 80), 'headers': _HEADERS}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(message):
+        pass
+
+    async def request():
+        chunks = list(_CHUNKS)
+
+        async def receive():
+            await asyncio.sleep(latency)
+            return {'type': 'http.request', 'body': chunks.pop(0),
+                    'more_body': bool(chunks)}
+
+        async with semaphore:
+            (credentials, environ) = await plugin.identify(scope, receive)
+            await plugin.respond(environ, send)
+
+    start = perf_counter()
+    await asyncio.gather(*[request() for i in range(requests)])
+    return requests / (perf_counter() - start)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--concurrency', default='10,100,1000',
+                        help='comma-separated amounts of concurrent requests')
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='requests per run')
+    parser.add_argument('--threads', type=int, default=32,
+                        help='size of the thread pool for the WSGI plugin')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='milliseconds before each chunk of the body')
+    options = parser.parse_args(argv)
+    latency = options.latency / 1000
+    for concurrency in [int(amount)
+                        for amount in options.concurrency.split(',')]:
+        wsgi = asyncio.run(run_wsgi(concurrency, options.requests,
+                                    options.threads, latency))
+        asgi = asyncio.run(run_asgi(concurrency, options.requests, latency))
+        print('%5d concurrent: WSGI (%d threads) %9.0f req/s, '
+              'ASGI %9.0f req/s' % (concurrency, options.threads, wsgi, asgi))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Benchmark the shared table of failed login attempts under contention.
+
+Every process checks and records failures for random logins, as in a
+credential-stuffing attack, and the aggregated throughput is reported for
+each amount of processes::
+
+    python benchmarks/bench_failtable.py [--processes 1,2,4,8] [--hot-keys N]
+
+With ``--hot-keys``, all the processes hit the same few keys, so they compete
+for the same buckets.
+
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+from argparse import ArgumentParser
+from multiprocessing import Barrier, Process, Queue
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+from repoze.who.plugins.friendlyform.failtable import FailedAttemptTable
+
+
+def worker(path, operations, hot_keys, barrier, results):
+    table = FailedAttemptTable(path)
+    generator = random.Random(os.getpid())
+    if hot_keys:
+        logins = ['user%d' % i for i in range(hot_keys)]
+    else:
+        logins = ['user%d' % generator.randrange(10 ** 6)
+                  for i in range(operations)]
+    barrier.wait()
+    start = perf_counter()
+    for i in range(operations):
+        login = logins[i % len(logins)]
+        table.check_and_record(login, '10.0.0.1')
+    results.put(perf_counter() - start)
+    table.close()
+
+
+def run(processes, operations, hot_keys, size):
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'failures')
+        FailedAttemptTable(path, size=size).close()
+        barrier = Barrier(processes)
+        results = Queue()
+        workers = [Process(target=worker,
+                           args=(path, operations, hot_keys, barrier,
+                                 results))
+                   for i in range(processes)]
+        for process in workers:
+            process.start()
+        durations = [results.get() for process in workers]
+        for process in workers:
+            process.join()
+    finally:
+        rmtree(directory)
+    return processes * operations / max(durations)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--processes', default='1,2,4,8',
+                        help='comma-separated amounts of processes')
+    parser.add_argument('-n', '--operations', type=int, default=20000,
+                        help='check+record operations per process')
+    parser.add_argument('--hot-keys', type=int, default=0,
+                        help='amount of keys shared by all the processes')
+    parser.add_argument('--size', type=int, default=65536,
+                        help='amount of buckets in the table')
+    options = parser.parse_args(argv)
+    for processes in [int(amount) for amount in options.processes.split(',')]:
+        throughput = run(processes, options.operations, options.hot_keys,
+                         options.size)
+        print('%3d processes: %10.0f ops/s (%8.0f ops/s per process)' %
+              (processes, throughput, throughput / processes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
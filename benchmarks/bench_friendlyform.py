@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Microbenchmarks for the hot paths of :class:`FriendlyFormPlugin`.
+
+Run the whole suite with::
+
+    python benchmarks/bench_friendlyform.py
+
+Results can be saved as a JSON baseline and later runs can be compared with
+it; the exit status is 1 if any case got slower than allowed::
+
+    python benchmarks/bench_friendlyform.py --save baseline.json
+    python benchmarks/bench_friendlyform.py --compare baseline.json \\
+        --max-regression 10
+
+Each call gets its own environ, built before the timer starts, because the
+plugin modifies it.
+
+The memory used by each plugin instance is reported with ``--memory``.
+
+The ``reference`` cases run a frozen copy of the plugin as released in
+version 1.0.8 (``reference_friendlyform.py``), for comparison.
+
+"""
+from __future__ import print_function
+
+import json
+import platform
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+import environs
+import reference_friendlyform
+
+__all__ = ['CASES', 'run_case', 'run_suite', 'compare']
+
+
+def _identify(plugin_factory, environ_factory):
+    plugin = plugin_factory()
+
+    def setup(number):
+        return [environ_factory() for i in range(number)]
+
+    def run(environs):
+        identify = plugin.identify
+        for environ in environs:
+            identify(environ)
+
+    return setup, run
+
+
+def _challenge(plugin_factory, environ_factory):
+    plugin = plugin_factory()
+    app_headers = [('Content-Type', 'text/html'), ('Set-Cookie', 'a=1')]
+    forget_headers = [('Set-Cookie', 'auth_tkt=""; Path=/')]
+
+    def setup(number):
+        return [environ_factory() for i in range(number)]
+
+    def run(environs):
+        challenge = plugin.challenge
+        for environ in environs:
+            challenge(environ, '401 Unauthorized', app_headers,
+                      forget_headers)
+
+    return setup, run
+
+
+environ_marker = object()
+
+
+def _helper(method_name, *args):
+    plugin = environs.make_plugin()
+    method = getattr(plugin, method_name)
+    environ = environs.make_environ('/', SCRIPT_NAME='/my-app')
+    args = [environ if arg is environ_marker else arg for arg in args]
+
+    def setup(number):
+        return range(number)
+
+    def run(iterations):
+        for i in iterations:
+            method(*args)
+
+    return setup, run
+
+
+def _attribute_lookups(get_holder):
+    holder = get_holder(environs.make_plugin())
+
+    def setup(number):
+        return range(number)
+
+    def run(iterations):
+        for i in iterations:
+            holder.charset
+            holder.max_login_body
+            holder.query_strings
+            holder.ignore_trailing_slash
+
+    return setup, run
+
+
+def _reference(method_name, environ_factory):
+    plugin_factory = lambda: reference_friendlyform.FriendlyFormPlugin(
+        '/login', '/login_handler', None, '/logout_handler', None, 'cookie')
+    if method_name == 'identify':
+        return _identify(plugin_factory, environ_factory)
+    return _challenge(plugin_factory, environ_factory)
+
+
+CASES = [
+    ('identify.page_view',
+     lambda: _identify(environs.make_plugin, environs.page_view)),
+    ('identify.page_view.stats',
+     lambda: _identify(lambda: environs.make_plugin(collect_stats=True),
+                       environs.page_view)),
+    ('identify.page_view.localized',
+     lambda: _identify(environs.make_localized_plugin, environs.page_view)),
+    ('identify.page_view.tenants',
+     lambda: _identify(environs.make_tenant_plugin,
+                       environs.tenant_page_view)),
+    ('identify.login_form',
+     lambda: _identify(environs.make_plugin, environs.login_form)),
+    ('identify.login_form.state_cookie',
+     lambda: _identify(
+         lambda: environs.make_plugin(
+             state_cookie_secret=environs.STATE_COOKIE_SECRET),
+         environs.login_form_with_state_cookie)),
+    ('identify.login_handler',
+     lambda: _identify(environs.make_plugin, environs.login_handler)),
+    ('identify.login_handler.post_login_url',
+     lambda: _identify(
+         lambda: environs.make_plugin('/welcome_back', query_strings=['lang']),
+         lambda: environs.login_handler([('lang', 'es')]))),
+    ('identify.login_handler.localized',
+     lambda: _identify(
+         lambda: environs.make_localized_plugin(ignore_trailing_slash=True),
+         lambda: environs.make_environ(
+             '/sv/login_handler/', 'login=gustavo&password=secret'))),
+    ('identify.login_handler.allowed_redirects',
+     lambda: _identify(
+         lambda: environs.make_plugin(
+             allowed_redirects=environs.make_allowed_redirects()),
+         environs.login_handler_to_tenant)),
+    ('identify.logout_handler',
+     lambda: _identify(environs.make_plugin, environs.logout_handler)),
+    ('challenge.failed_login',
+     lambda: _challenge(environs.make_plugin, environs.failed_login)),
+    ('challenge.failed_login.state_cookie',
+     lambda: _challenge(
+         lambda: environs.make_plugin(
+             state_cookie_secret=environs.STATE_COOKIE_SECRET),
+         environs.failed_login)),
+    ('challenge.logout',
+     lambda: _challenge(lambda: environs.make_plugin(None, '/see_you'),
+                        environs.logout_handler)),
+    ('helpers.insert_qs_variable',
+     lambda: _helper('_insert_qs_variable', '/welcome?a=1&b=2', 'came_from',
+                     'http://example.org/blog')),
+    ('helpers.make_post_login_url',
+     lambda: _helper('_make_post_login_url',
+                     environs.make_plugin('/welcome?a=1&b=2')._get_route(
+                         '/login_handler')[1],
+                     '', 'http://example.org/blog', (('lang', 'es'), ), 2)),
+    ('helpers.config_lookups',
+     lambda: _attribute_lookups(lambda plugin: plugin._config)),
+    ('reference.property_lookups',
+     lambda: _attribute_lookups(lambda plugin: plugin)),
+    ('helpers.get_full_path',
+     lambda: _helper('_get_full_path', '/welcome', environ_marker)),
+    ('reference.identify.page_view',
+     lambda: _reference('identify', environs.page_view)),
+    ('reference.identify.login_handler',
+     lambda: _reference('identify', environs.login_handler)),
+    ('reference.challenge.failed_login',
+     lambda: _reference('challenge', environs.failed_login)),
+    ]
+
+
+def run_case(case, number, repeat):
+    """Return the best time per call for the ``case``, in nanoseconds."""
+    (setup, run) = case()
+    timings = []
+    for i in range(repeat):
+        data = setup(number)
+        start = perf_counter()
+        run(data)
+        timings.append(perf_counter() - start)
+    return min(timings) / number * 1e9
+
+
+def run_suite(number=10000, repeat=5, selection=None):
+    """Return the results of the cases whose name contain ``selection``."""
+    results = {}
+    for (name, case) in CASES:
+        if selection and selection not in name:
+            continue
+        results[name] = run_case(case, number, repeat)
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """
+    Return the ``(name, baseline, current)`` timings of the cases which are
+    more than ``max_regression`` percent slower than in the ``baseline``.
+
+    """
+    regressions = []
+    for (name, timing) in sorted(results.items()):
+        base_timing = baseline.get(name)
+        if not base_timing:
+            continue
+        if (timing - base_timing) / base_timing * 100 > max_regression:
+            regressions.append((name, base_timing, timing))
+    return regressions
+
+
+def measure_memory(instances=1000):
+    """
+    Return the bytes allocated per plugin instance and the size of its
+    compiled configuration, compared with the size of its instance dict.
+
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    plugins = [environs.make_plugin('/welcome', '/see_you', ['lang'])
+               for i in range(instances)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat
+                    in after.compare_to(before, 'filename'))
+    plugin = plugins[0]
+    return {
+        'plugin': allocated / instances,
+        'config': sys.getsizeof(plugin._config),
+        'instance_dict': sys.getsizeof(plugin.__dict__),
+        }
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='calls per timing (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timings per case (default: %(default)s)')
+    parser.add_argument('-k', '--select', metavar='TEXT',
+                        help='only run the cases whose name contain TEXT')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a JSON baseline')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        metavar='PERCENT',
+                        help='allowed slowdown when comparing '
+                             '(default: %(default)s%%)')
+    parser.add_argument('--memory', action='store_true',
+                        help='report the memory used per plugin instance')
+    options = parser.parse_args(argv)
+
+    if options.memory:
+        memory = measure_memory()
+        print('%-42s %9.0f B' % ('memory.plugin_instance', memory['plugin']))
+        print('%-42s %9d B' % ('memory.compiled_config', memory['config']))
+        print('%-42s %9d B' % ('memory.instance_dict',
+                               memory['instance_dict']))
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    results = run_suite(options.number, options.repeat, options.select)
+    for (name, timing) in sorted(results.items()):
+        if name in baseline and baseline[name]:
+            change = (timing - baseline[name]) / baseline[name] * 100
+            print('%-42s %9.0f ns %+7.1f%%' % (name, timing, change))
+        else:
+            print('%-42s %9.0f ns' % (name, timing))
+
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'results': results},
+                      baseline_file, indent=2, sort_keys=True)
+
+    if options.compare:
+        regressions = compare(results, baseline, options.max_regression)
+        for (name, base_timing, timing) in regressions:
+            print('REGRESSION: %s went from %.0f ns to %.0f ns' %
+                  (name, base_timing, timing), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Load test a complete repoze.who stack with the plugin over HTTP::
+
+    python benchmarks/bench_stack.py [--servers 4] [--clients 8] [-n 500]
+
+The stack is the repoze.who middleware with the plugin, an in-memory
+authenticator and the auth_tkt identifier as rememberer, in front of an
+application with a protected page. It's served by ``--servers`` pre-forked
+processes sharing a listening socket on the loopback interface, and
+``--clients`` processes run ``-n`` times each of the login, failed login,
+logout and protected page flows against it.
+
+Unlike the microbenchmarks, the figures (requests per second and latency
+percentiles by flow) include the middleware, the authenticators, the
+challenge decider and the HTTP round trip. The stack is built with the
+standard library's WSGI server, which needs ``fork`` (i.e., a POSIX
+system), so the absolute figures are only comparable between runs on the
+same machine.
+
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from time import perf_counter
+from urllib.parse import urlencode, urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from zope.interface import implementer
+
+from repoze.who.classifiers import default_challenge_decider, \
+    default_request_classifier
+from repoze.who.interfaces import IAuthenticator
+from repoze.who.middleware import PluggableAuthenticationMiddleware
+from repoze.who.plugins.auth_tkt import AuthTktCookiePlugin
+
+from repoze.who.plugins.friendlyform import FriendlyFormPlugin
+
+USERS = {'gustavo': 'secret'}
+
+_FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+# The steps of each flow: The method, the path (or ``None`` to follow the
+# redirection of the previous step), the body, whether the authentication
+# cookie is sent and the expected status.
+FLOWS = [
+    ('protected_page.anonymous', [
+        ('GET', '/protected', None, False, 302),
+        ]),
+    ('protected_page.authenticated', [
+        ('GET', '/protected', None, True, 200),
+        ]),
+    ('login', [
+        ('POST', '/login_handler',
+         urlencode({'login': 'gustavo', 'password': 'secret',
+                    'came_from': '/protected'}), False, 302),
+        ]),
+    ('failed_login', [
+        ('POST', '/login_handler',
+         urlencode({'login': 'gustavo', 'password': 'wrong',
+                    'came_from': '/protected'}), False, 302),
+        # The application denies access and the plugin challenges again:
+        ('GET', None, None, False, 302),
+        ]),
+    ('logout', [
+        ('GET', '/logout_handler', None, True, 302),
+        ]),
+    ]
+
+
+@implementer(IAuthenticator)
+class InMemoryAuthenticator(object):
+    """Authenticator of the users in a dictionary of logins and passwords."""
+
+    def __init__(self, users):
+        self.users = users
+
+    def authenticate(self, environ, identity):
+        login = identity.get('login')
+        if login is not None and self.users.get(login) == \
+           identity.get('password'):
+            return login
+        return None
+
+
+def application(environ, start_response):
+    """Application whose ``/protected`` pages require authentication."""
+    if (environ['PATH_INFO'].startswith('/protected') and
+        'REMOTE_USER' not in environ):
+        start_response('401 Unauthorized', [('Content-Type', 'text/plain')])
+        return [b'Unauthorized']
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello, %s' % environ.get('REMOTE_USER', 'anonymous')
+            .encode('utf-8')]
+
+
+def make_stack(app=application):
+    """Return the repoze.who middleware with the plugin around ``app``."""
+    form = FriendlyFormPlugin('/login', '/login_handler', None,
+                              '/logout_handler', None, 'auth_tkt')
+    auth_tkt = AuthTktCookiePlugin('benchmark', 'auth_tkt')
+    return PluggableAuthenticationMiddleware(
+        app,
+        identifiers=[('form', form), ('auth_tkt', auth_tkt)],
+        authenticators=[('auth_tkt', auth_tkt),
+                        ('users', InMemoryAuthenticator(USERS))],
+        challengers=[('form', form)],
+        mdproviders=[],
+        request_classifier=default_request_classifier,
+        challenge_decider=default_challenge_decider)
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(WSGIServer):
+
+    request_queue_size = 1024
+
+
+def start_servers(processes, context):
+    """
+    Serve the stack from ``processes`` forked processes sharing a listening
+    socket, and return the port and the processes.
+
+    """
+    server = _Server(('127.0.0.1', 0), _QuietHandler)
+    server.set_app(make_stack())
+    workers = [context.Process(target=server.serve_forever)
+               for index in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    server.socket.close()
+    return (server.server_port, workers)
+
+
+def request(port, method, path, body=None, cookie=None):
+    """
+    Make the request and return its latency, its status and its
+    ``Location`` and ``Set-Cookie`` headers.
+
+    """
+    headers = {}
+    if body is not None:
+        headers.update(_FORM_HEADERS)
+    if cookie:
+        headers['Cookie'] = cookie
+    start = perf_counter()
+    connection = HTTPConnection('127.0.0.1', port)
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+    finally:
+        connection.close()
+    latency = perf_counter() - start
+    return (latency, response.status, response.getheader('Location'),
+            response.msg.get_all('Set-Cookie') or [])
+
+
+def log_in(port):
+    """Return the authentication cookie of the user."""
+    (latency, status, location, cookies) = request(
+        port, 'POST', '/login_handler',
+        urlencode({'login': 'gustavo', 'password': 'secret'}))
+    for cookie in cookies:
+        if cookie.startswith('auth_tkt='):
+            return cookie.split(';', 1)[0]
+    raise AssertionError('The login did not set the authentication cookie')
+
+
+def run_flow(port, steps, cookie, latencies):
+    """Run the ``steps`` of a flow and return how many went wrong."""
+    errors = 0
+    location = None
+    for (method, path, body, authenticated, expected_status) in steps:
+        if path is None:
+            path = urlsplit(location)
+            path = path.path + ('?' + path.query if path.query else '')
+        (latency, status, location, cookies) = request(
+            port, method, path, body, cookie if authenticated else None)
+        latencies.append(latency)
+        if status != expected_status:
+            errors += 1
+    return errors
+
+
+def client(port, steps, flows, barrier, results):
+    cookie = log_in(port)
+    latencies = []
+    barrier.wait()
+    start = perf_counter()
+    errors = 0
+    for index in range(flows):
+        errors += run_flow(port, steps, cookie, latencies)
+    results.put((perf_counter() - start, latencies, errors))
+
+
+def run_scenario(port, steps, clients, flows, context):
+    """
+    Run the flow made of ``steps`` ``flows`` times from each of the
+    ``clients`` processes and return the requests per second, the latency
+    percentiles and the amount of unexpected responses.
+
+    """
+    barrier = context.Barrier(clients)
+    results = context.Queue()
+    workers = [context.Process(target=client,
+                               args=(port, steps, flows, barrier, results))
+               for index in range(clients)]
+    for worker in workers:
+        worker.start()
+    durations = []
+    latencies = []
+    errors = 0
+    for worker in workers:
+        (duration, client_latencies, client_errors) = results.get()
+        durations.append(duration)
+        latencies.extend(client_latencies)
+        errors += client_errors
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    percentiles = dict(
+        (percentile, latencies[min(int(len(latencies) * percentile / 100.0),
+                                   len(latencies) - 1)])
+        for percentile in (50, 99))
+    return (len(latencies) / max(durations), percentiles, errors)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    cpus = os.cpu_count() or 1
+    parser.add_argument('--servers', type=int, default=cpus,
+                        help='server processes (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=cpus,
+                        help='client processes (default: %(default)s)')
+    parser.add_argument('-n', '--flows', type=int, default=500,
+                        help='flows per client (default: %(default)s)')
+    parser.add_argument('-k', '--select', metavar='TEXT',
+                        help='only run the flows whose name contain TEXT')
+    options = parser.parse_args(argv)
+
+    context = multiprocessing.get_context('fork')
+    (port, servers) = start_servers(options.servers, context)
+    print('%d server processes, %d client processes, %d flows per client'
+          % (options.servers, options.clients, options.flows))
+    failed = False
+    try:
+        for (name, steps) in FLOWS:
+            if options.select and options.select not in name:
+                continue
+            (throughput, percentiles, errors) = run_scenario(
+                port, steps, options.clients, options.flows, context)
+            print('%-30s %9.0f req/s   p50 %7.2f ms   p99 %7.2f ms%s' % (
+                name, throughput, percentiles[50] * 1000,
+                percentiles[99] * 1000,
+                '   %d UNEXPECTED RESPONSES' % errors if errors else ''))
+            failed = failed or bool(errors)
+    finally:
+        for server in servers:
+            server.terminate()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Stress a single plugin instance from several threads and report the
+throughput for each amount of threads::
+
+    python benchmarks/bench_threads.py [--threads 1,2,4,8] [-n 20000]
+
+Every thread runs a mix of page views, login form views, logins and failed
+login challenges, and checks the results, so it doubles as a stress test.
+Run it with a free-threaded build of CPython (e.g., ``python3.13t``) to
+compare the scaling with and without the GIL.
+
+"""
+from __future__ import print_function
+
+import sys
+import sysconfig
+from argparse import ArgumentParser
+from threading import Barrier, Thread
+from time import perf_counter
+
+import environs
+
+
+def worker(plugin, operations, barrier, durations, errors):
+    app_headers = [('Set-Cookie', 'a=1')]
+    forget_headers = [('Set-Cookie', 'auth_tkt=""; Path=/')]
+    barrier.wait()
+    start = perf_counter()
+    for i in range(operations // 4):
+        plugin.identify(environs.page_view())
+        environ = environs.login_form()
+        plugin.identify(environ)
+        if environ['repoze.who.logins'] != 2:
+            errors.append(environ)
+        environ = environs.login_handler()
+        if plugin.identify(environ) is None:
+            errors.append(environ)
+        environ = environs.failed_login()
+        plugin.challenge(environ, '401 Unauthorized', app_headers,
+                         forget_headers)
+        if environ['repoze.who.logins'] != 2:
+            errors.append(environ)
+    durations.append(perf_counter() - start)
+
+
+def run(plugin_factory, threads, operations):
+    plugin = plugin_factory()
+    barrier = Barrier(threads)
+    durations = []
+    errors = []
+    workers = [Thread(target=worker,
+                      args=(plugin, operations, barrier, durations, errors))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise AssertionError('%d wrong results with %d threads' %
+                             (len(errors), threads))
+    return threads * operations / max(durations)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--threads', default='1,2,4,8',
+                        help='comma-separated amounts of threads')
+    parser.add_argument('-n', '--operations', type=int, default=20000,
+                        help='calls per thread')
+    parser.add_argument('--stats', action='store_true',
+                        help='collect the statistics of the plugin')
+    options = parser.parse_args(argv)
+
+    gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('Python %s, free-threaded build: %s, GIL enabled: %s' % (
+        sys.version.split()[0],
+        bool(sysconfig.get_config_var('Py_GIL_DISABLED')), gil_enabled))
+    factory = lambda: environs.make_plugin(redirect_cache_size=64,
+                                           collect_stats=options.stats)
+    baseline = None
+    for threads in [int(amount) for amount in options.threads.split(',')]:
+        throughput = run(factory, threads, options.operations)
+        if baseline is None:
+            baseline = throughput / threads
+        print('%3d threads: %10.0f calls/s (%3.0f%% scaling efficiency)'
+              % (threads, throughput, 100 * throughput / threads / baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
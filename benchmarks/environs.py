@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Synthetic WSGI environs for the benchmarks."""
+
+from io import BytesIO
+
+from urllib.parse import quote, urlencode
+
+from repoze.who.plugins.friendlyform import FriendlyFormPlugin
+from repoze.who.plugins.friendlyform.cookie import SignedStateCookie
+from repoze.who.plugins.friendlyform.tenants import TenantFriendlyFormPlugin
+
+__all__ = ['make_plugin', 'make_environ', 'page_view', 'login_form',
+           'login_handler', 'logout_handler', 'failed_login',
+           'STATE_COOKIE_SECRET', 'login_form_with_state_cookie',
+           'make_localized_plugin', 'LANGUAGES', 'make_tenant_plugin',
+           'tenant_page_view', 'login_handler_to_tenant',
+           'make_allowed_redirects']
+
+LANGUAGES = ('en', 'de', 'es', 'fr', 'it', 'nl', 'pl', 'pt', 'ru', 'sv',
+             'ja', 'ko', 'zh', 'ar', 'he', 'tr', 'cs', 'da', 'fi', 'no')
+
+STATE_COOKIE_SECRET = 'benchmark'
+
+
+def make_plugin(post_login_url=None, post_logout_url=None,
+                query_strings=None, **kwargs):
+    """Return the plugin configuration used by all the benchmarks."""
+    return FriendlyFormPlugin('/login', '/login_handler', post_login_url,
+                              '/logout_handler', post_logout_url, 'cookie',
+                              query_strings=query_strings, **kwargs)
+
+
+def make_localized_plugin(**kwargs):
+    """Return a plugin with a login form and handlers for each language."""
+    return FriendlyFormPlugin(
+        ['/%s/login' % language for language in LANGUAGES],
+        dict(('/%s/login_handler' % language, '/%s/welcome' % language)
+             for language in LANGUAGES),
+        None,
+        ['/%s/logout_handler' % language for language in LANGUAGES],
+        None, 'cookie', **kwargs)
+
+
+def make_tenant_plugin(tenants=10000, **kwargs):
+    """Return a multi-tenant plugin with ``tenants`` configured tenants."""
+    configs = dict(
+        ('tenant%d.example.org' % index,
+         {'login_form_url': '/login', 'login_handler_path': '/login_handler',
+          'post_login_url': '/welcome/%d' % index,
+          'logout_handler_path': '/logout_handler'})
+        for index in range(tenants))
+    return TenantFriendlyFormPlugin(configs, post_logout_url=None,
+                                    rememberer_name='cookie', **kwargs)
+
+
+def make_environ(path_info, query_string='', body=None, **extra):
+    environ = {
+        'PATH_INFO': path_info,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'example.org',
+        'SERVER_PORT': '80',
+        'REQUEST_METHOD': 'GET',
+        'HTTP_HOST': 'example.org',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(b''),
+        }
+    if body is not None:
+        environ['REQUEST_METHOD'] = 'POST'
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ['wsgi.input'] = BytesIO(body)
+    environ.update(extra)
+    return environ
+
+
+def page_view():
+    return make_environ('/blog/2010/04/friendly-forms',
+                        'page=2&sort=date&q=repoze')
+
+
+def tenant_page_view():
+    environ = page_view()
+    environ['HTTP_HOST'] = 'tenant42.example.org'
+    return environ
+
+
+def login_form():
+    return make_environ('/login', '__logins=2&came_from=%2Fblog%2Fadmin')
+
+
+def login_form_with_state_cookie():
+    value = SignedStateCookie(STATE_COOKIE_SECRET).dumps('/blog/admin', 2)
+    return make_environ('/login', HTTP_COOKIE='friendlyform=' + value)
+
+
+def login_handler(extra_fields=()):
+    fields = [('login', 'gustavo'), ('password', 'secret'),
+              ('remember', '3600')]
+    fields.extend(extra_fields)
+    body = urlencode(fields).encode('ascii')
+    return make_environ('/login_handler',
+                        '__logins=1&came_from=%2Fblog%2Fadmin', body,
+                        HTTP_REFERER='http://example.org/login')
+
+
+def login_handler_to_tenant():
+    """Return a login request whose referrer URL is on a tenant's host."""
+    environ = login_handler()
+    environ['QUERY_STRING'] = ('__logins=1&came_from=' +
+                               quote('http://tenant42.example.org/blog'))
+    return environ
+
+
+def make_allowed_redirects(tenants=10000):
+    """Return the allowed redirect targets for ``tenants`` tenants."""
+    return ['tenant%d.example.org' % index for index in range(tenants)]
+
+
+def logout_handler():
+    return make_environ('/logout_handler', 'came_from=%2Fblog',
+                        HTTP_REFERER='http://example.org/blog')
+
+
+def failed_login():
+    environ = make_environ('/login_handler', '__logins=1')
+    environ['repoze.who.logins'] = 1
+    return environ
@@ -13,7 +13,15 @@
 #
 ##############################################################################
 
-"""Collection of :mod:`repoze.who` friendly forms"""
+"""
+Frozen copy of :class:`FriendlyFormPlugin` as released in version 1.0.8,
+before the optimizations of version 1.1, for the reference cases of
+``bench_friendlyform.py``.
+
+Only the import of ``parse_qs`` was fixed, so that it runs under Python 3.
+It must not be changed otherwise.
+
+"""
 
 try:
     from urlparse import urlparse, urlunparse
@@ -28,7 +36,7 @@ except ImportError:
 try:
     from urlparse import parse_qs
 except ImportError:#pragma: no cover
-    from cgi import parse_qs
+    from urllib.parse import parse_qs
 
 from webob import Request
 # TODO: Stop using Paste; we already started using WebOb
@@ -0,0 +1,1745 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+"""
+Collection of :mod:`repoze.who` friendly forms
+
+Only the standard library modules used on every request are imported with
+this module. WebOb and the modules used by optional features are imported
+when they are first needed, to keep the start-up of the workers fast.
+
+"""
+
+from urllib.parse import parse_qs, quote, quote_plus, unquote_plus, \
+    unquote_to_bytes, urlencode, urljoin, urlparse, urlunparse
+
+from codecs import lookup as lookup_codec
+from collections import OrderedDict
+from itertools import chain
+from operator import attrgetter
+from threading import Lock, RLock, local
+from time import perf_counter
+from weakref import finalize, ref
+
+from zope.interface import implementer
+
+from repoze.who.interfaces import IChallenger, IIdentifier
+
+__all__ = ['FriendlyFormPlugin', 'PAGE_VIEW', 'LOGIN_HANDLER',
+           'LOGOUT_HANDLER', 'LOGIN_FORM', 'FAILED_LOGIN']
+
+#{ Branches taken by the plugin on identification and challenge
+
+PAGE_VIEW = 'page_view'
+
+LOGIN_HANDLER = 'login_handler'
+
+LOGOUT_HANDLER = 'logout_handler'
+
+LOGIN_FORM = 'login_form'
+
+FAILED_LOGIN = 'failed_login'
+
+_IDENTIFY_BRANCHES = (PAGE_VIEW, LOGIN_HANDLER, LOGOUT_HANDLER, LOGIN_FORM)
+
+_CHALLENGE_BRANCHES = (LOGOUT_HANDLER, FAILED_LOGIN, LOGIN_FORM)
+
+#}
+
+# Paths which are not branches of the plugin:
+
+_STATS = 'stats'
+
+_METRICS = 'metrics'
+
+
+@implementer(IChallenger, IIdentifier)
+class FriendlyFormPlugin(object):
+    """
+    :class:`RedirectingFormPlugin
+    <repoze.who.plugins.form.RedirectingFormPlugin>`-like form plugin with
+    more features.
+
+    It is like ``RedirectingFormPlugin``, but provides us with the following
+    features:
+
+    * Users are not challenged on logout, unless the referrer URL is a
+      private one (but that's up to the application).
+    * Developers may define post-login and/or post-logout pages.
+    * In the login URL, the amount of failed logins is available in the
+      environ. It's also increased by one on every login try. This counter
+      will allow developers not using a post-login page to handle logins that
+      fail/succeed.
+
+    You should keep in mind that if you're using a post-login or a post-logout
+    page, that page will receive the referrer URL as a query string variable
+    whose name is "came_from".
+
+    Forms can be submitted with any encoding (non-ASCII credentials are
+    supported) and ISO-8859-1 (aka "Latin-1") is the default one.
+
+    If a ``state_cookie_secret`` is set, the referrer URL and the login
+    counter are carried in a signed cookie instead of the query string, so
+    they are not passed to the login form nor to the post-login page. In that
+    case, the referrer URL is available in the environ as
+    ``repoze.who.came_from`` while the cookie is alive, and the cookie is
+    removed once the user logs in.
+
+    If ``json_login`` is set, the login requests made by scripts (e.g., with
+    ``fetch()``) may have a JSON body and are answered without redirections:
+    With "200 OK" if the user was authenticated, or "401 Unauthorized"
+    otherwise, and a JSON object with the ``authenticated`` flag, the
+    ``destination`` of the user after logging in and the login counter
+    (``logins``), which has to be sent back on the next attempt.
+
+    A single instance may be shared by any amount of threads: The
+    configuration is copied into immutable objects when the plugin is
+    created, and the state of each request is only kept in local variables
+    and in its environ. The only shared mutable state is the memo of charsets
+    and the optional caches and statistics, which are thread-safe.
+
+    .. versionchanged:: 1.1
+        The settings passed to the constructor are read-only attributes,
+        because changing them would not change the compiled configuration.
+
+    """
+    classifications = {
+        IIdentifier: ["browser"],
+        IChallenger: ["browser"],
+        }
+
+    # The settings in the compiled configuration:
+    login_form_url = property(attrgetter('_config.login_form_url'))
+    login_handler_path = property(attrgetter('_config.login_handler_path'))
+    post_login_url = property(attrgetter('_config.post_login_url'))
+    logout_handler_path = property(attrgetter('_config.logout_handler_path'))
+    post_logout_url = property(attrgetter('_config.post_logout_url'))
+    login_counter_name = property(attrgetter('_config.counter_name'))
+    charset = property(attrgetter('_config.charset'))
+    max_login_body = property(attrgetter('_config.max_login_body'))
+    stats_path = property(attrgetter('_config.stats_path'))
+    metrics_path = property(attrgetter('_config.metrics_path'))
+    query_strings = property(attrgetter('_config.query_strings'))
+    ignore_trailing_slash = property(
+        attrgetter('_config.ignore_trailing_slash'))
+    allowed_redirects = property(attrgetter('_config.allowed_redirects'))
+    redirect_fallback = property(attrgetter('_config.redirect_fallback'))
+    json_login = property(attrgetter('_config.json_login'))
+
+    def __init__(self, login_form_url, login_handler_path, post_login_url,
+                 logout_handler_path, post_logout_url, rememberer_name,
+                 login_counter_name=None, charset="iso-8859-1",
+                 query_strings=None, redirect_cache_size=0,
+                 redirect_cache_max_entry_size=2048, max_login_body=None,
+                 collect_stats=False, stats_path=None, metrics=None,
+                 metrics_path=None, rate_limiter=None, failure_table=None,
+                 known_logins=None, allowed_redirects=None,
+                 redirect_fallback=None, json_login=False,
+                 state_cookie_secret=None, state_cookie_name='friendlyform',
+                 state_cookie_max_age=3600, ignore_trailing_slash=False):
+        """
+
+        :param login_form_url: The URL/path where the login form is located,
+            or a non-empty list of them (the first one is used on
+            challenges).
+        :type login_form_url: str
+        :param login_handler_path: The URL/path where the login form is
+            submitted to (where it is processed by this plugin), or a list of
+            them, or a dictionary with their post-login URLs.
+        :type login_handler_path: str
+        :param post_login_url: The URL/path where the user should be redirected
+            to after login (even if wrong credentials were provided).
+        :type post_login_url: str
+        :param logout_handler_path: The URL/path where the user is logged out,
+            or a list of them, or a dictionary with their post-logout URLs.
+        :type logout_handler_path: str
+        :param post_logout_url: The URL/path where the user should be
+            redirected to after logout.
+        :type post_logout_url: str
+        :param rememberer_name: The name of the repoze.who identifier which
+            acts as rememberer.
+        :type rememberer_name: str
+        :param login_counter_name: The name of the query string variable which
+            will represent the login counter.
+        :type login_counter_name: str
+        :param charset: The character encoding to be assumed when the user
+            agent does not submit the form with an explicit charset.
+        :type charset: :class:`str`
+        :param redirect_cache_size: The maximum amount of post-login and
+            post-logout destinations to be cached (``0`` disables the cache).
+        :type redirect_cache_size: :class:`int`
+        :param redirect_cache_max_entry_size: The length of the longest
+            destination URL that may be cached.
+        :type redirect_cache_max_entry_size: :class:`int`
+        :param max_login_body: The size (in bytes) of the largest body to be
+            accepted by the login handler, or ``None`` for no limit. Larger
+            requests are answered with a "413 Request Entity Too Large" error
+            without reading their body.
+        :type max_login_body: :class:`int`
+        :param collect_stats: Whether to keep the statistics returned by
+            :meth:`stats`.
+        :type collect_stats: :class:`bool`
+        :param stats_path: The URL/path where the statistics are served as
+            JSON, if any (this implies ``collect_stats``). It should only be
+            reachable from the internal network.
+        :type stats_path: :class:`str`
+        :param metrics: The collector of metrics to be notified of every
+            identification and challenge, if any.
+        :type metrics: :class:`~repoze.who.plugins.friendlyform.metrics.PrometheusMetrics`
+        :param metrics_path: The URL/path where the ``metrics`` are served in
+            the Prometheus text format, if any. It requires ``metrics`` and
+            should only be reachable from the internal network.
+        :type metrics_path: :class:`str`
+        :param rate_limiter: The limiter of login attempts, if any. Attempts
+            over the limit are answered with a "429 Too Many Requests" error
+            and their credentials are discarded.
+        :type rate_limiter: :class:`~repoze.who.plugins.friendlyform.ratelimit.LoginRateLimiter`
+        :param failure_table: The server-side table of failed login attempts,
+            if any. Clients which must back off are answered with a "429 Too
+            Many Requests" error and their credentials are discarded.
+        :type failure_table: :class:`~repoze.who.plugins.friendlyform.failtable.FailedAttemptTable`
+        :param known_logins: The filter of the logins which may exist, if
+            any. Credentials with other logins are discarded, so the login
+            fails without reaching the authenticators.
+        :type known_logins: :class:`~repoze.who.plugins.friendlyform.bloom.KnownLogins`
+        :param allowed_redirects: The patterns of the URLs the user may be
+            redirected to after login and logout, besides the paths on this
+            site (see
+            :class:`~repoze.who.plugins.friendlyform.redirects.RedirectAllowlist`),
+            or ``None`` to allow any URL.
+        :type allowed_redirects: :class:`list`
+        :param redirect_fallback: The URL/path used instead of the referrer
+            URLs which are not allowed. It defaults to the root of the
+            application.
+        :type redirect_fallback: :class:`str`
+        :param json_login: Whether to answer the login requests made by
+            scripts (those with a JSON body, a ``X-Requested-With:
+            XMLHttpRequest`` header or asking for JSON) with JSON instead of
+            redirections, and to accept JSON bodies with the credentials.
+        :type json_login: :class:`bool`
+        :param state_cookie_secret: The secret used to sign the cookie which
+            carries the referrer URL and the login counter, if they must not
+            be carried in the query string.
+        :type state_cookie_secret: :class:`str`
+        :param state_cookie_name: The name of that cookie.
+        :type state_cookie_name: :class:`str`
+        :param state_cookie_max_age: The amount of seconds that cookie is
+            valid for.
+        :type state_cookie_max_age: :class:`int`
+        :param ignore_trailing_slash: Whether the paths above should also
+            match when they are requested with (or without) a trailing slash.
+        :type ignore_trailing_slash: :class:`bool`
+
+        The login counter variable's name will be set to ``__logins`` if
+        ``login_counter_name`` equals None.
+
+        The post-login and post-logout URLs of the handlers in a dictionary
+        default to ``post_login_url`` and ``post_logout_url``, respectively,
+        if they are ``None``.
+
+        .. versionchanged:: 1.0.1
+            Added the ``charset`` argument.
+
+        .. versionchanged:: 1.1
+            Added the ``redirect_cache_size``,
+            ``redirect_cache_max_entry_size``, ``max_login_body``,
+            ``collect_stats``, ``stats_path``, ``metrics``, ``metrics_path``,
+            ``rate_limiter``, ``failure_table``, ``known_logins``,
+            ``allowed_redirects``, ``redirect_fallback``, ``json_login``,
+            ``state_cookie_secret``, ``state_cookie_name``,
+            ``state_cookie_max_age`` and
+            ``ignore_trailing_slash`` arguments. The handler and form paths
+            may be lists or dictionaries. ``query_strings`` and
+            ``allowed_redirects`` are copied into tuples.
+
+        """
+        self.rememberer_name = rememberer_name
+        if not login_counter_name:
+            login_counter_name = '__logins'
+        if metrics_path and metrics is None:
+            raise ValueError('metrics_path requires metrics')
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.failure_table = failure_table
+        self.known_logins = known_logins
+        if state_cookie_secret:
+            from repoze.who.plugins.friendlyform.cookie import \
+                SignedStateCookie
+            state_cookie = SignedStateCookie(
+                state_cookie_secret, state_cookie_name, state_cookie_max_age)
+        else:
+            state_cookie = None
+        if allowed_redirects is not None:
+            from repoze.who.plugins.friendlyform.redirects import \
+                RedirectAllowlist
+            allowed_redirects = tuple(allowed_redirects)
+            redirect_allowlist = RedirectAllowlist(allowed_redirects)
+        else:
+            redirect_allowlist = None
+        self._config = _Config(
+            login_form_url, login_handler_path, post_login_url,
+            logout_handler_path, post_logout_url, stats_path, metrics_path,
+            login_counter_name, charset, tuple(query_strings or ()),
+            max_login_body, state_cookie, ignore_trailing_slash,
+            allowed_redirects, redirect_allowlist, redirect_fallback,
+            json_login)
+        observers = []
+        if collect_stats or stats_path:
+            self._stats = _Stats()
+            observers.append(self._stats)
+        else:
+            self._stats = None
+        if metrics is not None:
+            observers.append(metrics)
+        self._observers = tuple(observers)
+        self._charsets = {}
+        if redirect_cache_size:
+            self._redirect_cache = _LRUCache(redirect_cache_size,
+                                             redirect_cache_max_entry_size)
+        else:
+            self._redirect_cache = None
+
+    # IIdentifier
+    def identify(self, environ):
+        """
+        Override the parent's identifier to introduce a login counter
+        (possibly along with a post-login page) and load the login counter into
+        the ``environ``.
+
+        Ordinary page views (i.e., not the login handler, the logout handler
+        nor the login form, and without the login counter in the query
+        string) are detected from the raw ``PATH_INFO`` and ``QUERY_STRING``
+        before any request object is built. Otherwise, only the variables
+        used by the plugin are decoded.
+
+        """
+        (branch, target) = self._get_route(environ['PATH_INFO'])
+        if branch == _STATS:
+            environ['repoze.who.application'] = _JSONResponse(self.stats())
+            return None
+        if branch == _METRICS:
+            environ['repoze.who.application'] = _TextResponse(
+                self.metrics.render().encode('utf-8'),
+                self.metrics.content_type)
+            return None
+        if not self._observers:
+            return self._identify(environ, branch, target)[1]
+        start = perf_counter()
+        (branch, credentials) = self._identify(environ, branch, target)
+        duration = perf_counter() - start
+        for observer in self._observers:
+            observer.identified(branch, duration, credentials)
+        return credentials
+
+    def _identify(self, environ, branch, target):
+        """
+        Identify the request on the path routed to ``branch`` (if any) and
+        return the branch taken, along with the credentials found (if any).
+
+        """
+        is_login_form = branch == LOGIN_FORM
+        if branch == LOGIN_HANDLER:
+            ## We are on the URL where repoze.who processes authentication. ##
+            return (LOGIN_HANDLER, self._identify_login(environ, target))
+        elif branch == LOGOUT_HANDLER:
+            ##    We are on the URL where repoze.who logs the user out.    ##
+            self._identify_logout(environ)
+            return (LOGOUT_HANDLER, None)
+        elif self._config.state_cookie is not None:
+            ##   The login counter may only be in the state cookie, which  ##
+            ##              is not there on most page views.              ##
+            if ((is_login_form or
+                 self._config.state_cookie.is_present(environ)) and
+                self._identify_state_cookie(environ, is_login_form)):
+                return (LOGIN_FORM, None)
+        elif (is_login_form or
+              self._may_have_logins(environ.get('QUERY_STRING', ''))):
+            ##  We are on the URL that displays the from OR any other page  ##
+            ##   where the login counter may be in the query string.      ##
+            if self._identify_login_form(environ, is_login_form):
+                return (LOGIN_FORM, None)
+        # There's nothing to do for this request.
+        return (PAGE_VIEW, None)
+
+    def _identify_login(self, environ, post_login_url):
+        """
+        Return the credentials submitted to the login handler, if any, and
+        redirect to its ``post_login_url`` or the referrer URL.
+
+        Let's append the login counter to the query string of the "came_from"
+        URL. It will be used by the challenge below if authorization is
+        denied for this request.
+
+        """
+        config = self._config
+        if (config.max_login_body is not None and
+            _get_content_length(environ) > config.max_login_body):
+            environ['repoze.who.application'] = _REQUEST_ENTITY_TOO_LARGE
+            return None
+        if self.rate_limiter is not None:
+            retry_after = self.rate_limiter.check_address(environ)
+            if retry_after is not None:
+                environ['repoze.who.application'] = \
+                    _make_too_many_requests(retry_after)
+                return None
+        charset = self._get_charset(environ.get('CONTENT_TYPE', ''))
+        query = _parse_fields(_get_query_string(environ), charset,
+                              config.login_fields)
+        # The variables in the query string take precedence, so there's
+        # no need to look for them in the body:
+        form = self._get_form(environ, charset,
+                              config.login_fields.difference(query))
+        form.update(query)
+        try:
+            login = form['login']
+            password = form['password']
+        except KeyError:
+            credentials = None
+        else:
+            if self.rate_limiter is not None:
+                retry_after = self.rate_limiter.check_login(login)
+                if retry_after is not None:
+                    environ['repoze.who.application'] = \
+                        _make_too_many_requests(retry_after)
+                    return None
+            if self.failure_table is not None:
+                address = environ.get(self.failure_table.address_key, '')
+                # The attempt is counted as a failure until it's remembered:
+                retry_after = self.failure_table.check_and_record(login,
+                                                                  address)
+                if retry_after is not None:
+                    environ['repoze.who.application'] = \
+                        _make_too_many_requests(retry_after)
+                    return None
+                environ[_ATTEMPT_KEY] = (login, address)
+            if (self.known_logins is not None and
+                login not in self.known_logins):
+                # The user doesn't exist, so the authenticators are spared.
+                credentials = None
+            elif charset == "us-ascii":
+                credentials = {
+                    'login': str(login),
+                    'password': str(password),
+                    }
+            else:
+                credentials = {'login': login,'password': password}
+
+        if credentials is not None and 'remember' in form:
+            credentials['max_age'] = form['remember']
+
+        if config.json_login and _is_json_request(environ):
+            self._set_json_login_response(environ, form, post_login_url)
+            return credentials
+
+        if config.state_cookie is not None:
+            self._set_login_destination(environ, form, post_login_url)
+            return credentials
+
+        failed_logins = self._get_logins(query, True)
+        if post_login_url:
+            # There's a post-login page, so we have to replace the
+            # destination with it. If there's a referrer URL defined, we
+            # have to pass it to the post-login page as a GET variable,
+            # along with the other variables to be forwarded.
+            forwarded_variables = _get_forwarded_variables(config, form)
+            new_dest = self._get_destination(
+                self._make_post_login_url,
+                post_login_url,
+                environ.get('SCRIPT_NAME', ''),
+                self._check_came_from(query.get('came_from'), environ),
+                forwarded_variables,
+                failed_logins)
+        else:
+            script_name = environ.get('SCRIPT_NAME') or '/'
+            referer = environ.get('HTTP_REFERER', script_name)
+            destination = self._check_came_from(
+                form.get('came_from', referer), environ)
+            new_dest = self._get_destination(self._set_logins_in_url,
+                                             destination, failed_logins)
+        environ['repoze.who.application'] = _Redirect(new_dest)
+        return credentials
+
+    def _set_login_destination(self, environ, form, post_login_url):
+        """
+        Redirect the login handler to its destination, passing the referrer
+        URL and the login counter in the state cookie.
+
+        Unlike in the query string, ``came_from`` may be submitted in the
+        body when there's a post-login page, since it's never forwarded.
+
+        """
+        state_cookie = self._config.state_cookie
+        state = state_cookie.load(environ)
+        (state_came_from, failed_logins) = state or (None, None)
+        came_from = self._check_came_from(
+            form.get('came_from') or state_came_from, environ)
+        failed_logins = failed_logins or 0
+        if post_login_url:
+            forwarded_variables = _get_forwarded_variables(self._config,
+                                                           form)
+            new_dest = self._get_destination(
+                self._make_post_login_url,
+                post_login_url,
+                environ.get('SCRIPT_NAME', ''),
+                None,
+                forwarded_variables,
+                None)
+        else:
+            script_name = environ.get('SCRIPT_NAME') or '/'
+            new_dest = came_from or self._check_came_from(
+                environ.get('HTTP_REFERER', script_name), environ)
+        cookie = state_cookie.make_header(environ, came_from, failed_logins)
+        environ['repoze.who.application'] = _Redirect(new_dest, [cookie])
+
+    def _set_json_login_response(self, environ, form, post_login_url):
+        """
+        Answer the login handler with JSON instead of redirecting, with the
+        login counter and the destination of the user after logging in.
+
+        Scripts have to send the counter back on the next attempt, and
+        ``came_from`` may be in the body.
+
+        """
+        script_name = environ.get('SCRIPT_NAME', '')
+        came_from = self._check_came_from(form.get('came_from'), environ)
+        if post_login_url:
+            destination = self._get_destination(
+                self._make_post_login_url,
+                post_login_url,
+                script_name,
+                came_from,
+                _get_forwarded_variables(self._config, form),
+                None)
+        else:
+            destination = came_from or self._check_came_from(
+                environ.get('HTTP_REFERER', script_name or '/'), environ)
+        response = _JSONLoginResponse(destination,
+                                      self._get_logins(form, True))
+        environ['repoze.who.application'] = response
+        # The challenge will answer with JSON too if the login fails:
+        environ[_JSON_LOGIN_KEY] = response
+
+    def _identify_logout(self, environ):
+        """Find the referrer URL and let the challenge log the user out."""
+        charset = self._get_charset(environ.get('CONTENT_TYPE', ''))
+        query = _parse_fields(_get_query_string(environ), charset,
+                              _LOGOUT_FIELDS)
+        form = self._get_form(environ, charset, _LOGOUT_FIELDS)
+        form.update(query)
+        script_name = environ.get('SCRIPT_NAME') or '/'
+        referer = environ.get('HTTP_REFERER', script_name)
+        came_from = self._check_came_from(form.get('came_from', referer),
+                                          environ)
+        # set in environ for self.challenge() to find later
+        environ['came_from'] = came_from
+        environ['repoze.who.application'] = _UNAUTHORIZED
+
+    def _identify_login_form(self, environ, is_login_form):
+        """
+        Load the login counter into the ``environ`` and then hide it from the
+        query string (it will cause problems in frameworks like TG2, where
+        this unexpected variable would be passed to the controller). The
+        rest of the query string is left as is.
+
+        Return whether the counter was loaded, which is always the case on the
+        login form.
+
+        """
+        counter_name = self._config.counter_name
+        query_string = _get_query_string(environ)
+        if (b'%' not in query_string and
+            self._config.counter_needle not in query_string):
+            # The counter is not there, so the query string is left alone.
+            if not is_login_form:
+                return False
+            environ['repoze.who.logins'] = 0
+            return True
+        charset = self._get_charset(environ.get('CONTENT_TYPE', ''))
+        (logins, query_string) = _strip_counter(
+            query_string, counter_name, self._config.counter_needle, charset)
+        if not is_login_form and not logins:
+            return False
+        environ['repoze.who.logins'] = _to_counter(logins)
+        # Hiding the GET variable in the environ:
+        if query_string is not None:
+            environ['QUERY_STRING'] = query_string.decode('latin-1')
+        return True
+
+    def _identify_state_cookie(self, environ, is_login_form):
+        """
+        Load the referrer URL and the login counter from the state cookie
+        into the ``environ``.
+
+        Return whether the counter was loaded, which is always the case on the
+        login form.
+
+        """
+        state = self._config.state_cookie.load(environ)
+        if state is None:
+            (came_from, logins) = (None, None)
+        else:
+            (came_from, logins) = state
+        if logins is None and not is_login_form:
+            return False
+        environ['repoze.who.logins'] = logins or 0
+        if came_from is not None:
+            environ['repoze.who.came_from'] = came_from
+        return True
+
+    # IChallenger
+    def challenge(self, environ, status, app_headers, forget_headers):
+        """
+        Override the parent's challenge to avoid challenging the user on
+        logout, introduce a post-logout page and/or pass the login counter
+        to the login form.
+
+        """
+        if not self._observers:
+            return self._challenge(environ, app_headers, forget_headers)[1]
+        start = perf_counter()
+        (branch, app) = self._challenge(environ, app_headers, forget_headers)
+        duration = perf_counter() - start
+        if branch == FAILED_LOGIN:
+            logins = environ['repoze.who.logins']
+        else:
+            logins = None
+        for observer in self._observers:
+            observer.challenged(branch, duration, logins)
+        return app
+
+    def _challenge(self, environ, app_headers, forget_headers):
+        """
+        Return the branch taken by the challenge, along with the WSGI
+        application which performs it.
+
+        """
+        json_login = environ.get(_JSON_LOGIN_KEY)
+        if json_login is not None:
+            # The login failed and the script is waiting for JSON.
+            environ['repoze.who.logins'] = json_login.logins + 1
+            return (FAILED_LOGIN, json_login.make_response(
+                False, chain(forget_headers, _get_cookies(app_headers))))
+
+        (branch, post_logout_url) = self._get_route(environ['PATH_INFO'])
+        if branch == LOGOUT_HANDLER:
+            # Let's log the user out without challenging.
+            came_from = environ.get('came_from')
+            if post_logout_url:
+                # Redirect to a predefined "post logout" URL.
+                destination = self._get_destination(
+                    self._make_post_logout_url,
+                    post_logout_url,
+                    environ.get('SCRIPT_NAME', ''),
+                    came_from)
+            else:
+                # Redirect to the referrer URL.
+                script_name = environ.get('SCRIPT_NAME', '')
+                destination = came_from or script_name or '/'
+
+        else:
+            branch = LOGIN_FORM
+            came_from = environ.get('came_from', None)
+            if came_from is None:
+                came_from = _get_request_url(environ)
+            if 'repoze.who.logins' in environ:
+                # Login failed! Let's redirect to the login form and include
+                # the login counter in the query string
+                environ['repoze.who.logins'] += 1
+                logins = environ['repoze.who.logins']
+                branch = FAILED_LOGIN
+            else:
+                logins = None
+            config = self._config
+            if config.state_cookie is None:
+                destination = config.login_form_template.build(
+                    environ.get('SCRIPT_NAME', ''), came_from, logins)
+            else:
+                destination = config.login_form_template.build_plain(
+                    environ.get('SCRIPT_NAME', ''))
+                forget_headers = list(forget_headers)
+                forget_headers.append(config.state_cookie.make_header(
+                    environ, came_from, logins))
+
+        app = _Redirect(destination,
+                        chain(forget_headers, _get_cookies(app_headers)))
+        return (branch, app)
+
+    # IIdentifier
+    def remember(self, environ, identity):
+        attempt = environ.pop(_ATTEMPT_KEY, None)
+        if attempt is not None:
+            # The login succeeded.
+            self.failure_table.reset(*attempt)
+        rememberer = self._get_rememberer(environ)
+        headers = rememberer.remember(environ, identity)
+        state_cookie = self._config.state_cookie
+        if state_cookie is not None and state_cookie.is_present(environ):
+            # The login counter must not survive a successful login.
+            headers = list(headers or [])
+            headers.append(state_cookie.make_expiration_header(environ))
+        return headers
+
+    # IIdentifier
+    def forget(self, environ, identity):
+        rememberer = self._get_rememberer(environ)
+        return rememberer.forget(environ, identity)
+
+    def stats(self):
+        """
+        Return the statistics of the plugin, or ``None`` if they are not
+        collected.
+
+        They are returned in a dictionary with the following items:
+
+        * ``identify``: The amount of calls and the time spent (in seconds)
+          in :meth:`identify`, by branch (``page_view``, ``login_handler``,
+          ``logout_handler`` and ``login_form``).
+        * ``challenge``: Likewise, for :meth:`challenge` (whose branches are
+          ``logout_handler``, ``failed_login`` and ``login_form``).
+        * ``credentials``: The amount of credentials found.
+        * ``failed_logins``: The amount of failed logins.
+        * ``logouts``: The amount of logouts.
+        * ``challenges``: The amount of challenges.
+
+        .. versionadded:: 1.1
+
+        """
+        if self._stats is None:
+            return None
+        return self._stats.get_snapshot()
+
+    def add_observer(self, observer):
+        """
+        Notify ``observer`` of every identification and challenge, like the
+        ``metrics``.
+
+        The ``observer`` must have an ``identified(branch, duration,
+        credentials)`` and a ``challenged(branch, duration, logins)`` method,
+        which are called with the branch taken by the plugin, the time it took
+        (in seconds) and the credentials found or the login counter,
+        respectively.
+
+        .. versionadded:: 1.1
+
+        """
+        # The tuple is replaced, so requests in progress are not affected:
+        self._observers = self._observers + (observer, )
+
+    def remove_observer(self, observer):
+        """
+        Stop notifying ``observer``, added with :meth:`add_observer`.
+
+        .. versionadded:: 1.1
+
+        """
+        observers = list(self._observers)
+        observers.remove(observer)
+        self._observers = tuple(observers)
+
+    def get_redirect_cache_stats(self):
+        """
+        Return the statistics of the post-login/post-logout destinations
+        cache, or ``None`` if it's disabled.
+
+        The statistics are returned in a dictionary with the ``size``,
+        ``hits``, ``misses``, ``evictions`` and ``oversized`` items; the latter
+        being the amount of destinations which were too long to be cached.
+
+        .. versionadded:: 1.1
+
+        """
+        if self._redirect_cache is None:
+            return None
+        return self._redirect_cache.get_stats()
+
+    def _get_rememberer(self, environ):
+        rememberer = environ['repoze.who.plugins'][self.rememberer_name]
+        return rememberer
+
+    def _get_route(self, path_info):
+        """
+        Return the branch and target of the plugin on ``path_info``, which
+        are ``None`` on ordinary page views.
+
+        """
+        config = self._config
+        # Most requests are page views, so no KeyError is raised for them:
+        route = config.routes.get(path_info)
+        if route is not None:
+            return route
+        if config.ignore_trailing_slash and path_info.endswith('/'):
+            return config.routes.get(_strip_trailing_slash(path_info),
+                                     _NO_ROUTE)
+        return _NO_ROUTE
+
+    def _get_full_path(self, path, environ):
+        """
+        Return the full path to ``path`` by prepending the SCRIPT_NAME.
+
+        If ``path`` is a URL, do nothing.
+
+        """
+        if path.startswith('/'):
+            path = environ.get('SCRIPT_NAME', '') + path
+        return path
+
+    def _check_came_from(self, came_from, environ):
+        """
+        Return the referrer URL ``came_from`` if the user may be redirected
+        to it, or the fallback URL otherwise.
+
+        """
+        allowlist = self._config.redirect_allowlist
+        if (came_from is None or allowlist is None or
+            allowlist.is_allowed(came_from, environ.get('HTTP_HOST') or
+                                 environ.get('SERVER_NAME'))):
+            return came_from
+        return (self._config.redirect_fallback or
+                environ.get('SCRIPT_NAME') or '/')
+
+    def _get_destination(self, builder, *args):
+        """
+        Return the URL built by calling ``builder`` with ``args``, using the
+        destinations cache if it's enabled.
+
+        """
+        if self._redirect_cache is None:
+            return builder(*args)
+        return self._redirect_cache.get(builder, args)
+
+    def _make_post_login_url(self, post_login_url, script_name, came_from,
+                             forwarded_variables, logins):
+        """
+        Return the pre-split ``post_login_url`` with the login counter and the
+        referrer URL (unless they are ``None``) and the
+        ``forwarded_variables`` in its query string.
+
+        """
+        variables = []
+        if logins is not None:
+            variables.append((self._config.counter_name, logins))
+        if came_from is not None:
+            variables.append(('came_from', came_from))
+        variables.extend(forwarded_variables)
+        return post_login_url.build(script_name, variables)
+
+    def _make_post_logout_url(self, post_logout_url, script_name, came_from):
+        """
+        Return the pre-split ``post_logout_url`` with the referrer URL (if
+        any) in its query string.
+
+        """
+        if came_from:
+            return post_logout_url.build(script_name,
+                                         [('came_from', came_from)])
+        return post_logout_url.build(script_name, ())
+
+    def _get_charset(self, content_type):
+        """
+        Return the charset declared in the ``content_type`` header or, if
+        there's none (or it's unknown), the default one.
+
+        The charset found for each distinct header value is memoized.
+
+        """
+        try:
+            return self._charsets[content_type]
+        except KeyError:
+            pass
+        charset = self._config.charset
+        for parameter in content_type.split(';')[1:]:
+            (name, sep, value) = parameter.partition('=')
+            if name.strip().lower() == 'charset':
+                value = value.strip().strip('"\'')
+                try:
+                    lookup_codec(value)
+                except LookupError:
+                    pass
+                else:
+                    charset = value
+                break
+        # Concurrent misses may store the same value twice or exceed the
+        # limit slightly, which is harmless:
+        if len(self._charsets) < _MAX_MEMOIZED_CHARSETS:
+            self._charsets[content_type] = charset
+        return charset
+
+    def _get_form(self, environ, charset, field_names):
+        """
+        Return the variables named in ``field_names`` from the body of the
+        request.
+
+        URL-encoded bodies are read in chunks and parsed as they arrive, until
+        all the variables are found; the others are left to WebOb.
+
+        """
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            return {}
+        content_type = environ.get('CONTENT_TYPE', '')
+        mimetype = content_type.split(';', 1)[0].strip().lower()
+        if mimetype == 'application/json' and self._config.json_login:
+            return _parse_json_fields(environ['wsgi.input'],
+                                      _get_content_length(environ),
+                                      field_names)
+        if mimetype == 'multipart/form-data':
+            from webob import Request
+            post = Request(environ).decode(charset).POST
+            return dict((name, value) for (name, value) in post.items()
+                        if name in field_names)
+        if mimetype not in ('', 'application/x-www-form-urlencoded'):
+            return {}
+        return _parse_stream_fields(environ['wsgi.input'],
+                                    _get_content_length(environ), charset,
+                                    field_names)
+
+    def _get_logins(self, query, force_typecast=False):
+        """
+        Return the login counter from the ``query`` string variables.
+
+        If it's not possible to convert it into an integer and
+        ``force_typecast`` is ``True``, it will be set to zero (int(0)).
+        Otherwise, it will be ``None`` or an string.
+
+        """
+        failed_logins = query.get(self._config.counter_name)
+        if force_typecast:
+            failed_logins = _to_counter(failed_logins)
+        return failed_logins
+
+    def _may_have_logins(self, query_string):
+        """
+        Check whether the login counter may be in the raw ``query_string``.
+
+        This is a conservative test: It may return ``True`` when the counter is
+        not there, but never ``False`` when it is.
+
+        """
+        if not query_string:
+            return False
+        counter_name = self._config.counter_name
+        if counter_name in query_string:
+            return True
+        if '%' in query_string or '+' in query_string:
+            # The variable name could be (partially) percent-encoded:
+            return counter_name in unquote_plus(query_string)
+        return False
+
+    def _set_logins_in_url(self, url, logins):
+        """
+        Insert the login counter variable with the ``logins`` value into
+        ``url`` and return the new URL.
+
+        """
+        return self._insert_qs_variable(url, self._config.counter_name,
+                                        logins)
+
+    def _insert_qs_variable(self, url, var_name, var_value):
+        """
+        Insert the variable ``var_name`` with value ``var_value`` in the query
+        string of ``url`` and return the new URL.
+
+        """
+        url_parts = list(urlparse(url))
+        query_parts = parse_qs(url_parts[4])
+        query_parts[var_name] = var_value
+        url_parts[4] = urlencode(query_parts, doseq=True)
+        return urlunparse(url_parts)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+_LOGOUT_FIELDS = frozenset(['came_from'])
+
+_NO_ROUTE = (None, None)
+
+_ATTEMPT_KEY = 'repoze.who.plugins.friendlyform.attempt'
+
+_JSON_LOGIN_KEY = 'repoze.who.plugins.friendlyform.json_login'
+
+_MAX_MEMOIZED_CHARSETS = 64
+
+_BODY_CHUNK_SIZE = 8192
+
+# Longer login counters are ignored, so that int() never gets huge numbers:
+_MAX_COUNTER_LENGTH = 9
+
+
+def _strip_trailing_slash(path):
+    """Remove the trailing slashes from ``path``, unless it's the root."""
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+    return path
+
+
+def _get_forwarded_variables(config, form):
+    """Return the variables in ``form`` to be passed to the post-login page."""
+    if not config.forwarded_fields.intersection(form):
+        return ()
+    return tuple((name, form[name]) for name in config.query_strings
+                 if name in form)
+
+
+def _get_targets(paths, default_target):
+    """
+    Return the ``(path, target)`` pairs for the ``paths`` given to the plugin,
+    which may be a single path, a list of paths or a dictionary with their
+    targets.
+
+    """
+    if isinstance(paths, dict):
+        return [(path, default_target if target is None else target)
+                for (path, target) in paths.items()]
+    if isinstance(paths, (list, tuple)):
+        return [(path, default_target) for path in paths]
+    return [(paths, default_target)]
+
+
+def _get_query_string(environ):
+    """Return the raw query string in the ``environ`` as bytes."""
+    return environ.get('QUERY_STRING', '').encode('latin-1')
+
+
+def _unquote(data, charset):
+    """Decode the URL-encoded ``data`` using ``charset``."""
+    return unquote_to_bytes(data.replace(b'+', b' ')).decode(charset,
+                                                               'replace')
+
+
+def _get_cookies(app_headers):
+    """
+    Return the cookies set by the application, which are the only headers
+    of its response to be kept, besides the forget headers, on challenges.
+
+    """
+    return ((h, v) for (h, v) in app_headers if h.lower() == 'set-cookie')
+
+
+def _get_content_length(environ):
+    """Return the length of the body of the request (zero if unknown)."""
+    try:
+        return max(int(environ.get('CONTENT_LENGTH') or 0), 0)
+    except ValueError:
+        return 0
+
+
+def _strip_counter(query_string, counter_name, counter_needle, charset):
+    """
+    Find the login counter in the raw ``query_string`` and remove it.
+
+    Return the decoded value of the counter (the last one, if repeated) and
+    the raw query string without it, with the other bytes untouched. Both are
+    ``None`` if the counter is not there.
+
+    The variable names are only decoded if they are percent-encoded.
+
+    """
+    value = None
+    kept_pairs = []
+    for pair in query_string.split(b'&'):
+        (name, sep, raw_value) = pair.partition(b'=')
+        if name == counter_needle or (
+                (b'%' in name or b'+' in name) and
+                _unquote(name, charset) == counter_name):
+            value = raw_value
+        else:
+            kept_pairs.append(pair)
+    if value is None:
+        return (None, None)
+    return (_unquote(value, charset), b'&'.join(kept_pairs))
+
+
+def _to_counter(value):
+    """
+    Return the login counter in the string ``value``, or zero if it's not an
+    integer (or it's too long).
+
+    """
+    if value and len(value) <= _MAX_COUNTER_LENGTH:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return 0
+
+
+def _parse_fields(data, charset, field_names):
+    """
+    Return the variables named in ``field_names`` from the URL-encoded
+    ``data``, without decoding the values of the other variables.
+
+    If a variable is repeated, its last value is used.
+
+    """
+    fields = {}
+    for pair in data.split(b'&'):
+        if pair:
+            (name, sep, value) = pair.partition(b'=')
+            name = _unquote(name, charset)
+            if name in field_names:
+                fields[name] = _unquote(value, charset)
+    return fields
+
+
+def _parse_stream_fields(stream, length, charset, field_names,
+                         chunk_size=_BODY_CHUNK_SIZE):
+    """
+    Return the variables named in ``field_names`` from the first ``length``
+    bytes of the URL-encoded ``stream``.
+
+    The stream is read in chunks of ``chunk_size`` bytes and reading stops as
+    soon as all the variables have been found, so a repeated variable only
+    takes its last value if it's found before that.
+
+    """
+    fields = {}
+    missing_fields = set(field_names)
+    parts = []
+    while length > 0 and missing_fields:
+        chunk = stream.read(min(chunk_size, length))
+        if not chunk:
+            length = 0
+            break
+        length -= len(chunk)
+        parts.append(chunk)
+        if b'&' not in chunk:
+            continue
+        pairs = b''.join(parts).split(b'&')
+        parts = [pairs.pop()]
+        for pair in pairs:
+            _add_field(fields, missing_fields, pair, charset, field_names)
+    if not length:
+        # The body was fully read, so the last variable is complete:
+        _add_field(fields, missing_fields, b''.join(parts), charset,
+                   field_names)
+    return fields
+
+
+def _parse_json_fields(stream, length, field_names):
+    """
+    Return the variables named in ``field_names`` from the JSON object in
+    the first ``length`` bytes of the ``stream``.
+
+    Numbers are converted into strings, like they would be in a form, and
+    the other values which are not strings are ignored.
+
+    """
+    import json
+    try:
+        data = json.loads(stream.read(length))
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    fields = {}
+    for name in field_names:
+        value = data.get(name)
+        if isinstance(value, str):
+            fields[name] = value
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            fields[name] = str(value)
+    return fields
+
+
+def _is_json_request(environ):
+    """
+    Return whether the request was made by a script which expects a JSON
+    response.
+
+    """
+    content_type = environ.get('CONTENT_TYPE', '')
+    return (content_type[:16].lower() == 'application/json' or
+            environ.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest' or
+            environ.get('HTTP_ACCEPT', '').startswith('application/json'))
+
+
+def _add_field(fields, missing_fields, pair, charset, field_names):
+    """Add the URL-encoded variable in ``pair`` if it's wanted."""
+    if pair:
+        (name, sep, value) = pair.partition(b'=')
+        name = _unquote(name, charset)
+        if name in field_names:
+            fields[name] = _unquote(value, charset)
+            missing_fields.discard(name)
+
+
+class _Config(object):
+    """
+    Compiled, read-only configuration of the plugin, used by the methods
+    which run on every request.
+
+    Besides the plain settings, it holds the values derived from them: The
+    table of the paths handled by the plugin (whose post-login and
+    post-logout URLs are pre-split), the login form URL template, the login
+    counter name as it appears in raw query strings, the sets of form
+    fields used by the plugin and the allowlist of redirect targets.
+
+    """
+
+    __slots__ = ('login_form_url', 'login_handler_path', 'post_login_url',
+                 'logout_handler_path', 'post_logout_url', 'stats_path',
+                 'metrics_path', 'routes', 'ignore_trailing_slash',
+                 'counter_name', 'counter_needle', 'charset', 'query_strings',
+                 'forwarded_fields', 'login_fields', 'max_login_body',
+                 'state_cookie', 'login_form_template', 'allowed_redirects',
+                 'redirect_allowlist', 'redirect_fallback', 'json_login')
+
+    def __init__(self, login_form_url, login_handler_path, post_login_url,
+                 logout_handler_path, post_logout_url, stats_path,
+                 metrics_path, counter_name, charset, query_strings,
+                 max_login_body, state_cookie, ignore_trailing_slash,
+                 allowed_redirects=None, redirect_allowlist=None,
+                 redirect_fallback=None, json_login=False):
+        if ignore_trailing_slash:
+            normalize_path = _strip_trailing_slash
+        else:
+            normalize_path = lambda path: path
+        # Every path handled by the plugin, along with its branch and target.
+        # The handlers take precedence over the login forms:
+        # The first login form URL is used on challenges, so they must be
+        # given in order:
+        if isinstance(login_form_url, (list, tuple)):
+            if not login_form_url:
+                raise ValueError('There must be at least one login form URL')
+            login_form_urls = list(login_form_url)
+        elif isinstance(login_form_url, str):
+            login_form_urls = [login_form_url]
+        else:
+            raise ValueError('The login form URL must be a string or a list '
+                             'of them, not %r' % (login_form_url,))
+        split_urls = {}
+        routes = {}
+        for (path, branch, target) in chain(
+                ((path, LOGIN_FORM, None) for path in login_form_urls),
+                ((path, LOGOUT_HANDLER, target) for (path, target)
+                 in _get_targets(logout_handler_path, post_logout_url)),
+                ((path, LOGIN_HANDLER, target) for (path, target)
+                 in _get_targets(login_handler_path, post_login_url)),
+                ((stats_path, _STATS, None), (metrics_path, _METRICS, None))):
+            if not path:
+                continue
+            if target:
+                if target not in split_urls:
+                    split_urls[target] = _SplitURL(target)
+                target = split_urls[target]
+            routes[normalize_path(path)] = (branch, target)
+
+        self.login_form_url = login_form_url
+        self.login_handler_path = login_handler_path
+        self.post_login_url = post_login_url
+        self.logout_handler_path = logout_handler_path
+        self.post_logout_url = post_logout_url
+        self.stats_path = stats_path
+        self.metrics_path = metrics_path
+        self.routes = routes
+        self.ignore_trailing_slash = ignore_trailing_slash
+        self.counter_name = counter_name
+        self.counter_needle = quote_plus(counter_name).encode('latin-1')
+        self.charset = charset
+        self.query_strings = query_strings
+        self.forwarded_fields = frozenset(query_strings)
+        self.login_fields = frozenset(
+            ['login', 'password', 'remember', 'came_from', counter_name] +
+            list(query_strings))
+        self.max_login_body = max_login_body
+        self.state_cookie = state_cookie
+        self.login_form_template = _LoginFormURLTemplate(
+            login_form_urls[0], counter_name)
+        self.allowed_redirects = allowed_redirects
+        self.redirect_allowlist = redirect_allowlist
+        self.redirect_fallback = redirect_fallback
+        self.json_login = json_login
+
+
+class _SplitURL(object):
+    """
+    Post-login or post-logout URL, split once so that only the variables
+    added to its query string have to be encoded on every request.
+
+    Like with :meth:`FriendlyFormPlugin._insert_qs_variable`, the added
+    variables replace the ones in the original query string.
+
+    """
+
+    __slots__ = ('url', 'base', 'query', 'fragment', 'is_path')
+
+    def __init__(self, url):
+        url_parts = urlparse(url)
+        self.url = url
+        self.base = urlunparse(url_parts[:4] + ('', ''))
+        self.query = parse_qs(url_parts[4])
+        if url_parts[5]:
+            self.fragment = '#' + url_parts[5]
+        else:
+            self.fragment = ''
+        self.is_path = url.startswith('/')
+
+    def build(self, script_name, variables):
+        """
+        Return the URL with the ``(name, value)`` pairs in ``variables`` in its
+        query string.
+
+        If the URL is a path, ``script_name`` is prepended to it.
+
+        """
+        if not variables:
+            url = self.url
+        else:
+            query = self.query.copy()
+            for (name, value) in variables:
+                query[name] = value
+            url = self.base + '?' + urlencode(query, doseq=True) + \
+                self.fragment
+        if self.is_path:
+            url = script_name + url
+        return url
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.url)
+
+
+class _LoginFormURLTemplate(object):
+    """
+    Pre-compiled login form URL, used to build the challenge destinations.
+
+    The login form URL is split and its query string is encoded once, so that
+    only the ``came_from`` value and the login counter have to be encoded on
+    every challenge. Those two variables are removed from the original query
+    string, if present, because they are always overridden.
+
+    """
+
+    def __init__(self, login_form_url, login_counter_name):
+        url_parts = urlparse(login_form_url)
+        query = parse_qs(url_parts[4])
+        query.pop('came_from', None)
+        query.pop(login_counter_name, None)
+        static_query = urlencode(query, doseq=True)
+
+        self.plain_url = urlunparse(url_parts[:4] + (static_query,
+                                                     url_parts[5]))
+        self.prefix = urlunparse(url_parts[:4] + ('', '')) + '?'
+        if static_query:
+            self.prefix += static_query + '&'
+        self.counter_prefix = quote_plus(login_counter_name) + '='
+        if url_parts[5]:
+            self.fragment = '#' + url_parts[5]
+        else:
+            self.fragment = ''
+        self.is_path = login_form_url.startswith('/')
+
+    def build(self, script_name, came_from, logins=None):
+        """
+        Return the login form URL with ``came_from`` and, unless it's
+        ``None``, the ``logins`` counter in the query string.
+
+        If the login form URL is a path, ``script_name`` is prepended to it.
+
+        """
+        url = self.prefix
+        if logins is not None:
+            url += self.counter_prefix + quote_plus(str(logins)) + '&'
+        url += 'came_from=' + quote_plus(came_from) + self.fragment
+        if self.is_path:
+            url = script_name + url
+        return url
+
+    def build_plain(self, script_name):
+        """
+        Return the login form URL without ``came_from`` and the login counter.
+
+        """
+        if self.is_path:
+            return script_name + self.plain_url
+        return self.plain_url
+
+
+class _Response(object):
+    """
+    Minimal WSGI application which serves a plain text response.
+
+    It's a lightweight replacement for the :mod:`webob.exc` exceptions, with
+    the status and headers encoded once.
+
+    """
+
+    content_type = 'text/plain; charset=UTF-8'
+
+    def __init__(self, status, explanation, headers=()):
+        self.status = status
+        self.code = int(status.split(' ', 1)[0])
+        self.body = ('%s\n\n%s' % (status, explanation)).encode('utf-8')
+        self.header_list = [('Content-Type', self.content_type),
+                            ('Content-Length', str(len(self.body)))]
+        self.header_list.extend(headers)
+
+    @property
+    def headers(self):
+        """The response headers, as a case-insensitive multi-dictionary."""
+        from webob.headers import ResponseHeaders
+        return ResponseHeaders(self.header_list[:])
+
+    def __call__(self, environ, start_response):
+        # The instance may be shared, so the headers are copied:
+        start_response(self.status, self.header_list[:])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [self.body]
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.status)
+
+
+class _TextResponse(_Response):
+    """
+    Minimal WSGI application which serves the ``body`` with the given
+    ``content_type``.
+
+    """
+
+    def __init__(self, body, content_type, status='200 OK', headers=()):
+        self.status = status
+        self.code = int(status.split(' ', 1)[0])
+        self.body = body
+        self.content_type = content_type
+        self.header_list = [('Content-Type', content_type),
+                            ('Content-Length', str(len(body))),
+                            ('Cache-Control', 'no-store')]
+        self.header_list.extend(headers)
+
+
+class _JSONResponse(_TextResponse):
+    """Minimal WSGI application which serves ``data`` as JSON."""
+
+    def __init__(self, data, status='200 OK', headers=()):
+        import json
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        super(_JSONResponse, self).__init__(body, 'application/json', status,
+                                            headers)
+
+
+class _JSONLoginResponse(object):
+    """
+    Answer of the login handler to scripts: "200 OK" if the user was
+    authenticated and "401 Unauthorized" otherwise, with the ``destination``
+    of the user after logging in and the login counter (the amount of failed
+    logins so far) in JSON.
+
+    When it's "401 Unauthorized", the challenge replaces it with the one
+    returned by :meth:`make_response` (along with the forget headers).
+
+    """
+
+    def __init__(self, destination, logins):
+        self.destination = destination
+        self.logins = logins
+
+    def make_response(self, authenticated, headers=()):
+        """Return the JSON response for the login attempt."""
+        if authenticated:
+            (status, logins) = ('200 OK', self.logins)
+        else:
+            (status, logins) = ('401 Unauthorized', self.logins + 1)
+        data = {
+            'authenticated': authenticated,
+            'destination': self.destination,
+            'logins': logins,
+            }
+        return _JSONResponse(data, status, headers)
+
+    def __call__(self, environ, start_response):
+        # The authenticators have run by now:
+        authenticated = environ.get('repoze.who.identity') is not None
+        return self.make_response(authenticated)(environ, start_response)
+
+
+class _Redirect(_Response):
+    """
+    "302 Found" response, the lightweight version of
+    :class:`webob.exc.HTTPFound`.
+
+    Like WebOb does, relative locations are resolved against the request URL
+    when the response is served.
+
+    """
+
+    status = '302 Found'
+
+    code = 302
+
+    def __init__(self, location, headers=()):
+        self.location = location
+        self.header_list = [('Content-Type', self.content_type), None,
+                            ('Location', location)]
+        self.header_list.extend(headers)
+
+    def __call__(self, environ, start_response):
+        location = self.location
+        if '://' not in location:
+            location = _make_absolute_url(location, environ)
+        body = (_REDIRECT_BODY % location).encode('utf-8')
+        header_list = self.header_list
+        header_list[1] = ('Content-Length', str(len(body)))
+        header_list[2] = ('Location', location)
+        start_response(self.status, header_list)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body]
+
+    @property
+    def headers(self):
+        """The response headers, as a case-insensitive multi-dictionary."""
+        header_list = self.header_list[:]
+        body = (_REDIRECT_BODY % self.location).encode('utf-8')
+        header_list[1] = ('Content-Length', str(len(body)))
+        from webob.headers import ResponseHeaders
+        return ResponseHeaders(header_list)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.location)
+
+
+_REDIRECT_BODY = ('302 Found\n\nThe resource was found at %s; you should be '
+                  'redirected automatically.')
+
+_UNAUTHORIZED = _Response(
+    '401 Unauthorized',
+    'This server could not verify that you are authorized to access the '
+    'document you requested. Either you supplied the wrong credentials '
+    '(e.g., bad password), or your browser does not understand how to '
+    'supply the credentials required.')
+
+_REQUEST_ENTITY_TOO_LARGE = _Response(
+    '413 Request Entity Too Large',
+    'The body of your request was too large for this server.')
+
+
+def _make_too_many_requests(retry_after):
+    """Return a "429 Too Many Requests" response."""
+    return _Response(
+        '429 Too Many Requests',
+        'Too many login attempts. Please try again in %d seconds.' %
+        retry_after,
+        [('Retry-After', str(retry_after))])
+
+
+# The characters which WebOb leaves unquoted in the request path:
+_PATH_SAFE = "/~!$&'()*+,;=:@"
+
+
+def _get_request_url(environ):
+    """
+    Return the full URL of the request, like :attr:`webob.Request.url`, but
+    without importing WebOb.
+
+    """
+    scheme = environ['wsgi.url_scheme']
+    host = environ.get('HTTP_HOST')
+    if host is not None:
+        if ':' in host and host[-1] != ']':
+            (host, port) = host.rsplit(':', 1)
+        else:
+            port = None
+    else:
+        host = environ['SERVER_NAME']
+        port = environ['SERVER_PORT']
+    url = scheme + '://' + host
+    if port and (scheme, port) not in (('http', '80'), ('https', '443')):
+        url += ':' + port
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    url += quote(path.encode('latin-1'), _PATH_SAFE)
+    query_string = environ.get('QUERY_STRING')
+    if query_string:
+        url += '?' + query_string
+    return url
+
+
+def _make_absolute_url(location, environ):
+    """Resolve the relative ``location`` against the request URL."""
+    scheme = environ['wsgi.url_scheme']
+    host = environ.get('HTTP_HOST')
+    if not host:
+        host = environ['SERVER_NAME']
+        port = environ['SERVER_PORT']
+        if (scheme, port) not in (('http', '80'), ('https', '443')):
+            host += ':' + port
+    host_url = scheme + '://' + host
+    if location.startswith('/'):
+        return host_url + location
+    path = quote(environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''))
+    return urljoin(host_url + path, location)
+
+
+class _Stats(object):
+    """
+    Counters and timings of the plugin.
+
+    Each thread updates its own counters, without locking, and they are only
+    added up when read. The counters are created beforehand for all the
+    branches, so the dictionaries are never resized while they may be read.
+    When a thread ends, its counters are added to those of the threads which
+    ended before, so they don't pile up on servers which start threads all
+    the time.
+
+    """
+
+    def __init__(self):
+        self._local = local()
+        self._live_counters = {}
+        self._ended_counters = _make_counters()
+        # Reentrant, because the counters of a thread may be retired while
+        # the lock is held in it (e.g., when a thread-local is collected):
+        self._lock = RLock()
+
+    def _get_counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = _make_counters()
+            # The owner lives as long as the thread, and the counters are
+            # retired when it's collected:
+            owner = _CountersOwner()
+            finalize(owner, _retire_counters, ref(self), counters)
+            with self._lock:
+                self._live_counters[id(counters)] = counters
+            self._local.owner = owner
+            self._local.counters = counters
+            return counters
+
+    def _retire(self, counters):
+        with self._lock:
+            if self._live_counters.pop(id(counters), None) is not None:
+                _add_counters(self._ended_counters, counters)
+
+    def identified(self, branch, duration, credentials):
+        counters = self._get_counters()
+        timing = counters['identify'][branch]
+        timing[0] += 1
+        timing[1] += duration
+        if credentials is not None:
+            counters['credentials'][0] += 1
+
+    def challenged(self, branch, duration, logins):
+        timing = self._get_counters()['challenge'][branch]
+        timing[0] += 1
+        timing[1] += duration
+
+    def get_snapshot(self):
+        totals = _make_counters()
+        with self._lock:
+            _add_counters(totals, self._ended_counters)
+            all_counters = list(self._live_counters.values())
+        for counters in all_counters:
+            _add_counters(totals, counters)
+        snapshot = {'credentials': totals['credentials'][0]}
+        for method in ('identify', 'challenge'):
+            snapshot[method] = dict(
+                (branch, {'calls': calls, 'seconds': seconds})
+                for (branch, (calls, seconds)) in totals[method].items())
+        challenges = snapshot['challenge']
+        snapshot['failed_logins'] = challenges[FAILED_LOGIN]['calls']
+        snapshot['logouts'] = snapshot['identify'][LOGOUT_HANDLER]['calls']
+        snapshot['challenges'] = sum(timing['calls']
+                                     for timing in challenges.values())
+        return snapshot
+
+
+class _CountersOwner(object):
+    """Object kept by a thread for as long as it lives."""
+
+    __slots__ = ('__weakref__', )
+
+
+def _make_counters():
+    return {
+        'identify': dict((branch, [0, 0.0]) for branch in _IDENTIFY_BRANCHES),
+        'challenge': dict((branch, [0, 0.0])
+                          for branch in _CHALLENGE_BRANCHES),
+        'credentials': [0],
+        }
+
+
+def _add_counters(totals, counters):
+    for method in ('identify', 'challenge'):
+        method_totals = totals[method]
+        for (branch, (calls, seconds)) in counters[method].items():
+            timing = method_totals[branch]
+            timing[0] += calls
+            timing[1] += seconds
+    totals['credentials'][0] += counters['credentials'][0]
+
+
+def _retire_counters(stats_ref, counters):
+    stats = stats_ref()
+    if stats is not None:
+        stats._retire(counters)
+
+
+class _LRUCache(object):
+    """
+    Thread-safe, size-bounded LRU cache of the URLs built by the plugin.
+
+    Items are keyed on the builder and its arguments. URLs longer than
+    ``max_entry_size`` are never stored, so that client-supplied values (like
+    ``came_from``) cannot be used to fill the memory.
+
+    """
+
+    def __init__(self, max_size, max_entry_size):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.oversized = 0
+
+    def get(self, builder, args):
+        """Return the URL for ``builder(*args)``, building it if necessary."""
+        key = (builder.__name__, ) + args
+        with self._lock:
+            try:
+                url = self._items[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return url
+
+        url = builder(*args)
+        if len(url) > self.max_entry_size:
+            with self._lock:
+                self.oversized += 1
+            return url
+
+        with self._lock:
+            self._items[key] = url
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+        return url
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'oversized': self.oversized,
+                }
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+asyncio counterpart of
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`, for ASGI
+applications.
+
+The request body is read from the ASGI ``receive`` channel before the
+plugin processes it, so the event loop is never blocked, and the responses
+of the plugin (e.g., redirections) are sent as ASGI messages. Everything
+else is done by the wrapped plugin::
+
+    plugin = AsyncFriendlyFormPlugin(FriendlyFormPlugin(...))
+
+    async def app(scope, receive, send):
+        (credentials, environ) = await plugin.identify(scope, receive)
+        if await plugin.respond(environ, send):
+            return
+        ...
+
+"""
+
+from io import BytesIO
+
+from repoze.who.plugins.friendlyform import LOGIN_HANDLER, LOGOUT_HANDLER, \
+    _get_content_length
+
+__all__ = ['AsyncFriendlyFormPlugin', 'scope_to_environ', 'send_response']
+
+
+_BODY_METHODS = frozenset(['POST', 'PUT', 'PATCH', 'DELETE'])
+
+
+class AsyncFriendlyFormPlugin(object):
+    """
+    Wrapper of a :class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`
+    with coroutines which take ASGI requests.
+
+    :param plugin: The plugin which does the actual work.
+    :type plugin: :class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`
+    :param extra_environ: The items to be added to the environ of every
+        request, like the ``repoze.who.plugins`` used by :meth:`remember` and
+        :meth:`forget`.
+    :type extra_environ: :class:`dict`
+
+    .. versionadded:: 1.1
+
+    """
+
+    def __init__(self, plugin, extra_environ=None):
+        self.plugin = plugin
+        self.extra_environ = extra_environ or {}
+
+    async def identify(self, scope, receive):
+        """
+        Identify the HTTP request in the ASGI ``scope`` and return the
+        credentials found (if any), along with the WSGI environ built for it.
+
+        The body is only read on the login and logout handlers.
+
+        """
+        environ = scope_to_environ(scope)
+        environ.update(self.extra_environ)
+        (branch, target) = self.plugin._get_route(environ['PATH_INFO'])
+        if (branch in (LOGIN_HANDLER, LOGOUT_HANDLER) and
+            environ['REQUEST_METHOD'] in _BODY_METHODS):
+            await self._read_body(environ, receive)
+        return (self.plugin.identify(environ), environ)
+
+    async def _read_body(self, environ, receive):
+        """
+        Read the body of the request into the ``environ``.
+
+        Bodies larger than the ``max_login_body`` of the plugin are not read
+        any further, since the plugin rejects them.
+
+        """
+        max_size = self.plugin.max_login_body
+        declared_size = _get_content_length(environ)
+        if max_size is not None and declared_size > max_size:
+            return
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] != 'http.request':
+                # The client disconnected.
+                break
+            chunk = message.get('body', b'')
+            chunks.append(chunk)
+            size += len(chunk)
+            more_body = message.get('more_body', False)
+            if max_size is not None and size > max_size:
+                break
+        environ['wsgi.input'] = BytesIO(b''.join(chunks))
+        if not declared_size or (max_size is not None and size > max_size):
+            environ['CONTENT_LENGTH'] = str(size)
+
+    async def challenge(self, environ, status, app_headers, forget_headers):
+        """
+        Return the WSGI application which challenges the user, to be sent
+        with :meth:`respond`.
+
+        """
+        return self.plugin.challenge(environ, status, app_headers,
+                                     forget_headers)
+
+    async def remember(self, environ, identity):
+        return self.plugin.remember(environ, identity)
+
+    async def forget(self, environ, identity):
+        return self.plugin.forget(environ, identity)
+
+    def add_observer(self, observer):
+        """
+        Notify ``observer`` of every identification and challenge (see
+        :meth:`FriendlyFormPlugin.add_observer
+        <repoze.who.plugins.friendlyform.FriendlyFormPlugin.add_observer>`).
+
+        """
+        self.plugin.add_observer(observer)
+
+    def remove_observer(self, observer):
+        """Stop notifying ``observer``."""
+        self.plugin.remove_observer(observer)
+
+    async def respond(self, environ, send):
+        """
+        Send the response set by :meth:`identify` in the ``environ``, if any,
+        and return whether it was sent.
+
+        """
+        app = environ.get('repoze.who.application')
+        if app is None:
+            return False
+        await send_response(app, environ, send)
+        return True
+
+
+def scope_to_environ(scope, body=b''):
+    """
+    Return the WSGI environ for the HTTP request in the ASGI ``scope``,
+    whose body is ``body``.
+
+    """
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+                       .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'asgi.scope': scope,
+        }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = server[0]
+    environ['SERVER_PORT'] = str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for (name, value) in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            value = environ[key] + separator + value
+        environ[key] = value
+    return environ
+
+
+async def send_response(app, environ, send):
+    """
+    Send the response of the WSGI ``app`` through the ASGI ``send`` channel.
+
+    The ``app`` must not block, like the responses of the plugin.
+
+    """
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    body = b''.join(app(environ, start_response))
+    (status, headers) = response
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for (name, value) in headers],
+        })
+    await send({'type': 'http.response.body', 'body': body})
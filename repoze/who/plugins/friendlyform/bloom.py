@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Bloom filter of the known logins, used by
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin` to discard the
+credentials of users who definitely don't exist before they reach the
+authenticators.
+
+The filter file can be built from a list of logins (one per line) with::
+
+    python -m repoze.who.plugins.friendlyform.bloom OUTPUT [INPUT]
+
+"""
+
+import logging
+import os
+import struct
+import sys
+from hashlib import blake2b
+from math import ceil, log
+from tempfile import mkstemp
+from threading import Lock, Thread
+from time import time
+
+__all__ = ['BloomFilter', 'KnownLogins']
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+_MAGIC = b'FFBLOOM1'
+
+# Magic, amount of bits and amount of hashes:
+_HEADER = struct.Struct('<8sQI')
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of strings.
+
+    Each item sets ``hashes`` bits out of ``size`` bits, derived from a single
+    BLAKE2 digest (using the Kirsch-Mitzenmacher technique), so items which
+    were added are always found, and other items are found with a
+    probability which depends on the amount of bits per item.
+
+    :param size: The amount of bits in the filter.
+    :type size: :class:`int`
+    :param hashes: The amount of bits set by each item.
+    :type hashes: :class:`int`
+
+    """
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        if bits is None:
+            bits = bytearray((size + 7) // 8)
+        self.bits = bits
+
+    @classmethod
+    def from_items(cls, items, false_positive_rate=0.001):
+        """
+        Return a filter with the ``items``, sized so that other items are found
+        with the given ``false_positive_rate``.
+
+        """
+        items = list(items)
+        amount = max(len(items), 1)
+        size = int(ceil(-amount * log(false_positive_rate) / log(2) ** 2))
+        hashes = max(int(round(size / amount * log(2))), 1)
+        bloom_filter = cls(size, hashes)
+        for item in items:
+            bloom_filter.add(item)
+        return bloom_filter
+
+    @classmethod
+    def load(cls, path):
+        """Return the filter stored in the file at ``path``."""
+        with open(path, 'rb') as filter_file:
+            data = filter_file.read()
+        if len(data) < _HEADER.size:
+            raise ValueError('%s is not a Bloom filter file' % path)
+        (magic, size, hashes) = _HEADER.unpack_from(data)
+        if (magic != _MAGIC or not size or not hashes or
+            len(data) != _HEADER.size + (size + 7) // 8):
+            raise ValueError('%s is not a Bloom filter file' % path)
+        return cls(size, hashes, bytearray(data[_HEADER.size:]))
+
+    def save(self, path):
+        """Store the filter in the file at ``path``, atomically."""
+        (directory, name) = os.path.split(path)
+        (descriptor, temporary_path) = mkstemp(
+            prefix=name + '.', suffix='.tmp', dir=directory or os.curdir)
+        try:
+            with os.fdopen(descriptor, 'wb') as filter_file:
+                filter_file.write(_HEADER.pack(_MAGIC, self.size, self.hashes))
+                filter_file.write(self.bits)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def add(self, item):
+        bits = self.bits
+        for index in self._get_indexes(item):
+            bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for index in self._get_indexes(item):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def _get_indexes(self, item):
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        (first_hash, second_hash) = struct.unpack('<QQ', digest)
+        size = self.size
+        return [(first_hash + index * second_hash) % size
+                for index in range(self.hashes)]
+
+
+class KnownLogins(object):
+    """
+    The Bloom filter of the known logins, stored in the file at ``path``.
+
+    The file is checked for changes at most every ``check_interval`` seconds
+    and reloaded if it was replaced (e.g., by another process), and the
+    filter can be rebuilt from the current logins in a background thread
+    with :meth:`rebuild`.
+
+    Until the file exists, all the logins are deemed known. If the file can't
+    be loaded (e.g., because it's being written by other means than
+    :meth:`BloomFilter.save`), the error is logged and the filter loaded
+    before, if any, is kept until the file is loaded successfully.
+
+    :param path: The path to the file with the filter.
+    :type path: :class:`str`
+    :param check_interval: The minimum amount of seconds between two checks
+        of the file.
+    :type check_interval: :class:`float`
+
+    .. versionadded:: 1.1
+
+    """
+
+    def __init__(self, path, check_interval=30):
+        self.path = path
+        self.check_interval = check_interval
+        self._filter = None
+        self._mtime = None
+        self._next_check = 0
+        self._lock = Lock()
+        self.refresh()
+
+    def __contains__(self, login):
+        if time() >= self._next_check:
+            self.refresh()
+        bloom_filter = self._filter
+        return bloom_filter is None or login in bloom_filter
+
+    def refresh(self):
+        """Reload the filter if its file changed."""
+        with self._lock:
+            self._next_check = time() + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                self._filter = BloomFilter.load(self.path)
+            except (OSError, ValueError) as error:
+                # It's tried again after the check interval.
+                _LOGGER.error('Could not load the known logins: %s', error)
+                return
+            self._mtime = mtime
+
+    def rebuild(self, get_logins, false_positive_rate=0.001, background=True):
+        """
+        Build a new filter with the logins returned by calling ``get_logins``
+        (e.g., from the database), store it and start using it.
+
+        Unless ``background`` is ``False``, it's done in a daemon thread,
+        which is returned.
+
+        """
+        def build():
+            bloom_filter = BloomFilter.from_items(get_logins(),
+                                                  false_positive_rate)
+            bloom_filter.save(self.path)
+            with self._lock:
+                self._filter = bloom_filter
+                self._mtime = os.stat(self.path).st_mtime
+
+        if not background:
+            build()
+            return None
+        thread = Thread(target=build)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    """Build the filter file with the logins read from a file or stdin."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) not in (1, 2):
+        sys.stderr.write('Usage: python -m %s OUTPUT [INPUT]\n' % __name__)
+        return 2
+    if len(argv) == 2:
+        with open(argv[1]) as input_file:
+            logins = [line.rstrip('\n') for line in input_file]
+    else:
+        logins = [line.rstrip('\n') for line in sys.stdin]
+    BloomFilter.from_items(login for login in logins if login).save(argv[0])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Signed cookie which carries the referrer URL and the login counter, instead
+of the ``came_from`` and ``__logins`` query string variables.
+
+"""
+
+import hmac
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from hashlib import sha256
+from time import time
+
+__all__ = ['SignedStateCookie']
+
+
+class SignedStateCookie(object):
+    """
+    HMAC-signed cookie with the referrer URL and the login counter.
+
+    The value of the cookie is the URL-safe Base64 encoding of the time it
+    was issued, the login counter and the referrer URL, followed by a
+    truncated HMAC-SHA256 signature of it.
+
+    :param secret: The secret used to sign the cookie.
+    :type secret: :class:`str`
+    :param name: The name of the cookie.
+    :type name: :class:`str`
+    :param max_age: The amount of seconds the cookie is valid for.
+    :type max_age: :class:`int`
+
+    """
+
+    def __init__(self, secret, name='friendlyform', max_age=3600):
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.name = name
+        self.max_age = max_age
+        self._needle = name + '='
+
+    def is_present(self, environ):
+        """Check whether the cookie may be in the request, without parsing it."""
+        return self._needle in environ.get('HTTP_COOKIE', '')
+
+    def load(self, environ, now=None):
+        """
+        Return the referrer URL and the login counter in the cookie sent with
+        the request, or ``None`` if it's absent, expired or forged.
+
+        Either value may be ``None``.
+
+        """
+        cookies = environ.get('HTTP_COOKIE', '')
+        if self._needle not in cookies:
+            return None
+        for cookie in cookies.split(';'):
+            (name, sep, value) = cookie.strip().partition('=')
+            if name == self.name:
+                return self.loads(value, now)
+        return None
+
+    def dumps(self, came_from, logins, now=None):
+        """Return the signed cookie value for ``came_from`` and ``logins``."""
+        if now is None:
+            now = time()
+        if logins is None:
+            logins = ''
+        payload = '%d|%s|%s' % (now, logins, came_from or '')
+        payload = _encode(payload.encode('utf-8'))
+        return payload + '.' + self._sign(payload)
+
+    def loads(self, value, now=None):
+        """
+        Return the referrer URL and the login counter in the cookie ``value``,
+        or ``None`` if it's expired or forged.
+
+        """
+        (payload, sep, signature) = value.strip('"').rpartition('.')
+        try:
+            # The value is compared as bytes because it may contain any
+            # character, and those which aren't ASCII can't be signed:
+            if not hmac.compare_digest(self._sign(payload).encode('ascii'),
+                                       signature.encode('ascii')):
+                return None
+            payload = _decode(payload).decode('utf-8')
+            (issued, logins, came_from) = payload.split('|', 2)
+            issued = int(issued)
+            logins = int(logins) if logins else None
+        except (Base64Error, UnicodeError, TypeError, ValueError):
+            return None
+        if now is None:
+            now = time()
+        if not issued <= now < issued + self.max_age:
+            return None
+        return (came_from or None, logins)
+
+    def make_header(self, environ, came_from, logins):
+        """Return the ``Set-Cookie`` header for ``came_from`` and ``logins``."""
+        value = self.dumps(came_from, logins)
+        return ('Set-Cookie', '%s=%s; Max-Age=%d%s' % (
+            self.name, value, self.max_age, self._get_attributes(environ)))
+
+    def make_expiration_header(self, environ):
+        """Return the ``Set-Cookie`` header which removes the cookie."""
+        return ('Set-Cookie', '%s=; Max-Age=0%s' % (
+            self.name, self._get_attributes(environ)))
+
+    def _get_attributes(self, environ):
+        attributes = '; Path=%s; HttpOnly; SameSite=Lax' % (
+            environ.get('SCRIPT_NAME') or '/')
+        if environ.get('wsgi.url_scheme') == 'https':
+            attributes += '; Secure'
+        return attributes
+
+    def _sign(self, payload):
+        digest = hmac.new(self.secret, payload.encode('ascii'), sha256)
+        return _encode(digest.digest()[:16])
+
+
+def _encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(data):
+    return urlsafe_b64decode((data + '=' * (-len(data) % 4)).encode('ascii'))
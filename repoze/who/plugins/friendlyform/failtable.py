@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Server-side table of failed login attempts, shared by all the processes on a
+host through a memory-mapped file.
+
+"""
+
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from math import ceil
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:#pragma: no cover
+    # Without POSIX record locks, the table can only be shared by threads.
+    fcntl = None
+
+__all__ = ['FailedAttemptTable']
+
+
+_MAGIC = b'FFFAILT1'
+
+# Magic, amount of buckets, bucket size and hash key:
+_HEADER = struct.Struct('<8sII16s')
+
+# Key hash (zero if the bucket is empty), failures and time of the last one:
+_BUCKET = struct.Struct('<QI4xd')
+
+
+class FailedAttemptTable(object):
+    """
+    Table of failed login attempts, keyed by login and client address.
+
+    The table is a fixed-size, open-addressing hash table stored in the file
+    at ``path``, which is created if necessary. Every key is looked up in a
+    window of ``max_probe`` consecutive buckets, which is locked while it's
+    used, so all the operations are O(1). When the window is full, the bucket
+    with the oldest failure is reused.
+
+    Login attempts are counted as failures when they are made and the counter
+    is reset when they succeed. After ``free_attempts`` failures, the client
+    must wait ``backoff_base * backoff_factor ** n`` seconds (up to
+    ``max_backoff``) after the last failure, where ``n`` is the amount of
+    failures beyond the free ones. A plain lockout is achieved with a
+    ``backoff_factor`` of 1.
+
+    :param path: The path to the file shared by the processes.
+    :type path: :class:`str`
+    :param size: The amount of buckets in the table.
+    :type size: :class:`int`
+    :param max_age: The amount of seconds after which failures are forgotten.
+    :type max_age: :class:`float`
+    :param max_probe: The amount of buckets where a key may be stored.
+    :type max_probe: :class:`int`
+    :param address_key: The environ key with the client address.
+    :type address_key: :class:`str`
+
+    """
+
+    def __init__(self, path, size=65536, max_age=900, max_probe=8,
+                 free_attempts=3, backoff_base=1, backoff_factor=2,
+                 max_backoff=900, address_key='REMOTE_ADDR'):
+        self.path = path
+        self.size = size
+        self.max_age = max_age
+        self.max_probe = min(max_probe, size)
+        self.free_attempts = free_attempts
+        self.backoff_base = backoff_base
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.address_key = address_key
+        self._lock = Lock()
+        self._file_size = _HEADER.size + size * _BUCKET.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._hash_key = self._initialize()
+        self._map = mmap.mmap(self._fd, self._file_size)
+
+    def _initialize(self):
+        """Create the table in the file, unless it exists, and return its key."""
+        self._lock_range(0, _HEADER.size)
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0)
+            if len(header) < _HEADER.size or not header.startswith(_MAGIC):
+                hash_key = os.urandom(16)
+                os.ftruncate(self._fd, self._file_size)
+                os.pwrite(self._fd, _HEADER.pack(_MAGIC, self.size,
+                                                 _BUCKET.size, hash_key), 0)
+                return hash_key
+            (magic, size, bucket_size, hash_key) = _HEADER.unpack(header)
+            if size != self.size or bucket_size != _BUCKET.size:
+                raise ValueError('%s has %d buckets, not %d' %
+                                 (self.path, size, self.size))
+            return hash_key
+        finally:
+            self._unlock_range(0, _HEADER.size)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def check(self, login, address, now=None):
+        """
+        Return the amount of seconds the client at ``address`` must wait
+        before trying to log in as ``login`` again, or ``None`` if it can try
+        now.
+
+        """
+        if now is None:
+            now = time()
+        return self._update(login, address, now, None)[2]
+
+    def check_and_record(self, login, address, now=None):
+        """
+        Count an attempt to log in as ``login`` from ``address`` as a failure
+        if the client can try now, like :meth:`check` followed by
+        :meth:`record_failure`, but atomically, so that concurrent attempts
+        can't all pass the check before any of them is recorded.
+
+        Return the amount of seconds the client must wait, or ``None`` if
+        the attempt was recorded.
+
+        .. versionadded:: 1.1
+
+        """
+        if now is None:
+            now = time()
+        return self._update(login, address, now, 1, True)[2]
+
+    def get_failures(self, login, address, now=None):
+        """Return the amount of recent failures for ``login`` at ``address``."""
+        if now is None:
+            now = time()
+        return self._update(login, address, now, None)[0]
+
+    def record_failure(self, login, address, now=None):
+        """
+        Count a failure for ``login`` at ``address`` and return the amount of
+        recent failures.
+
+        """
+        if now is None:
+            now = time()
+        return self._update(login, address, now, 1)[0]
+
+    def reset(self, login, address):
+        """Forget the failures for ``login`` at ``address``."""
+        self._update(login, address, time(), 0)
+
+    def _update(self, login, address, now, increment, enforce=False):
+        """
+        Return the failures of the key, the time of the last one and the
+        amount of seconds the client had to wait (or ``None``), after adding
+        ``increment`` to them (or resetting them if it's zero).
+
+        If ``enforce`` is set, nothing is added if the client had to wait.
+
+        """
+        key_hash = self._hash(login, address)
+        start = key_hash % (self.size - self.max_probe + 1)
+        offset = _HEADER.size + start * _BUCKET.size
+        length = self.max_probe * _BUCKET.size
+        deadline = now - self.max_age
+        with self._lock:
+            self._lock_range(offset, length)
+            try:
+                found = free = oldest = None
+                oldest_time = None
+                for index in range(self.max_probe):
+                    bucket_offset = offset + index * _BUCKET.size
+                    (bucket_hash, failures, last_failure) = \
+                        _BUCKET.unpack_from(self._map, bucket_offset)
+                    if bucket_hash == 0 or last_failure < deadline:
+                        if free is None:
+                            free = bucket_offset
+                        continue
+                    if bucket_hash == key_hash:
+                        found = bucket_offset
+                        break
+                    if oldest_time is None or last_failure < oldest_time:
+                        (oldest, oldest_time) = (bucket_offset, last_failure)
+
+                if found is None:
+                    (failures, last_failure) = (0, 0.0)
+                    if not increment:
+                        return (failures, last_failure, None)
+                    found = oldest if free is None else free
+                retry_after = self._get_retry_after(failures, last_failure,
+                                                    now)
+                if increment is None or (enforce and retry_after is not None):
+                    return (failures, last_failure, retry_after)
+                if increment == 0:
+                    _BUCKET.pack_into(self._map, found, 0, 0, 0.0)
+                    return (0, 0.0, retry_after)
+                failures += increment
+                _BUCKET.pack_into(self._map, found, key_hash, failures, now)
+                return (failures, now, retry_after)
+            finally:
+                self._unlock_range(offset, length)
+
+    def _get_retry_after(self, failures, last_failure, now):
+        if failures < self.free_attempts:
+            return None
+        delay = min(self.backoff_base *
+                    self.backoff_factor ** (failures - self.free_attempts),
+                    self.max_backoff)
+        waiting_time = delay - (now - last_failure)
+        if waiting_time <= 0:
+            return None
+        return max(int(ceil(waiting_time)), 1)
+
+    def _hash(self, login, address):
+        data = ('%s\0%s' % (login, address)).encode('utf-8')
+        digest = blake2b(data, digest_size=8, key=self._hash_key).digest()
+        # Zero marks empty buckets:
+        return struct.unpack('<Q', digest)[0] or 1
+
+    def _lock_range(self, offset, length):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+
+    def _unlock_range(self, offset, length):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Prometheus metrics for :class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`.
+
+The metrics of a single process can be served by the plugin itself (see its
+``metrics_path`` argument) or written to a file for the textfile collector of
+the node exporter.
+
+With pre-fork servers, each worker must be given the same ``directory``,
+where it writes its own metrics periodically. They are merged when rendered,
+or by running::
+
+    python -m repoze.who.plugins.friendlyform.metrics DIRECTORY [OUTPUT]
+
+Each process writes a file named after its identifier and the time it
+started, so a process which gets the identifier of a dead one never takes
+its counts for its own. The files of dead processes are kept, so that the
+counters never go backwards, but they should be folded into a single file
+with :func:`mark_process_dead` when a worker exits. E.g., with Gunicorn::
+
+    def child_exit(server, worker):
+        mark_process_dead(METRICS_DIRECTORY, worker.pid)
+
+"""
+
+import atexit
+import json
+import os
+import sys
+from bisect import bisect_left
+from glob import glob
+from threading import Lock, get_ident
+from time import time
+
+try:
+    import fcntl
+except ImportError:#pragma: no cover
+    # Without POSIX record locks, dead processes must be marked one by one.
+    fcntl = None
+
+__all__ = ['PrometheusMetrics', 'collect', 'mark_process_dead', 'render',
+           'write_textfile']
+
+
+#: The default upper bounds of the latency histograms, in seconds.
+DEFAULT_LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025,
+                           0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1)
+
+#: The default upper bounds of the histogram of failed login counters.
+DEFAULT_LOGINS_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+
+_FILE_PREFIX = 'friendlyform-'
+
+# The file with the metrics of the dead processes:
+_DEAD_PROCESSES_FILE = _FILE_PREFIX + 'dead.json'
+
+_LOCK_FILE = 'friendlyform.lock'
+
+_METRICS = (
+    ('friendlyform_identify_seconds', 'histogram',
+     'Time spent identifying requests, by branch.'),
+    ('friendlyform_challenge_seconds', 'histogram',
+     'Time spent challenging requests, by branch.'),
+    ('friendlyform_failed_logins', 'histogram',
+     'Values of the login counter seen on failed logins.'),
+    ('friendlyform_credentials_total', 'counter',
+     'Credentials found on the login handler.'),
+    )
+
+
+class PrometheusMetrics(object):
+    """
+    Collector of latency histograms and counters for the plugin.
+
+    :param directory: The directory shared by all the processes, where each
+        one writes its metrics. If ``None``, only the metrics of the current
+        process are available.
+    :type directory: :class:`str`
+    :param flush_interval: The minimum amount of seconds between two writes
+        of the metrics of the current process into the ``directory``.
+    :type flush_interval: :class:`float`
+    :param latency_buckets: The upper bounds of the latency histograms.
+    :param logins_buckets: The upper bounds of the histogram of the login
+        counter values seen on failed logins.
+
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, directory=None, flush_interval=10,
+                 latency_buckets=DEFAULT_LATENCY_BUCKETS,
+                 logins_buckets=DEFAULT_LOGINS_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.latency_buckets = tuple(latency_buckets)
+        self.logins_buckets = tuple(logins_buckets)
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._last_flush = time()
+        self._pid = None
+        self._file_name = None
+        if directory is not None:
+            atexit.register(self._flush_at_exit)
+
+    # Observer of the plugin
+    def identified(self, branch, duration, credentials):
+        with self._lock:
+            self._observe('friendlyform_identify_seconds', branch,
+                          self.latency_buckets, duration)
+            if credentials is not None:
+                key = ('friendlyform_credentials_total', '')
+                self._counters[key] = self._counters.get(key, 0) + 1
+        self._maybe_flush()
+
+    # Observer of the plugin
+    def challenged(self, branch, duration, logins):
+        with self._lock:
+            self._observe('friendlyform_challenge_seconds', branch,
+                          self.latency_buckets, duration)
+            if logins is not None:
+                self._observe('friendlyform_failed_logins', '',
+                              self.logins_buckets, logins)
+        self._maybe_flush()
+
+    def _observe(self, name, branch, buckets, value):
+        key = (name, branch)
+        try:
+            histogram = self._histograms[key]
+        except KeyError:
+            histogram = self._histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+    def get_state(self):
+        """Return the metrics of the current process, as JSON-able data."""
+        with self._lock:
+            return {
+                'histograms': [[name, branch, histogram.to_dict()]
+                               for ((name, branch), histogram)
+                               in self._histograms.items()],
+                'counters': [[name, branch, value] for ((name, branch), value)
+                             in self._counters.items()],
+                }
+
+    def _maybe_flush(self):
+        if (self.directory is not None and
+            time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the metrics of the current process into the ``directory``,
+        replacing the previous ones atomically.
+
+        """
+        pid = os.getpid()
+        with self._lock:
+            self._last_flush = time()
+            if self._pid != pid:
+                # This is a new process (e.g., a forked worker).
+                self._file_name = '%s%d-%d.json' % (_FILE_PREFIX, pid,
+                                                    time() * 1000000)
+                self._pid = pid
+            path = os.path.join(self.directory, self._file_name)
+        _write_atomically(path, json.dumps(self.get_state()))
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except (IOError, OSError):
+            # The directory may be gone by now.
+            pass
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+
+        If there's a ``directory``, the metrics of all the processes are
+        merged.
+
+        """
+        if self.directory is None:
+            return render(self.get_state())
+        self.flush()
+        return render(collect(self.directory))
+
+    def write_textfile(self, path):
+        """Write the rendered metrics to ``path``, atomically."""
+        _write_atomically(path, self.render())
+
+
+def collect(directory):
+    """Return the merged metrics of all the processes in ``directory``."""
+    return _merge(glob(os.path.join(directory, _FILE_PREFIX + '*.json')))
+
+
+def mark_process_dead(directory, pid):
+    """
+    Fold the metrics of the dead process ``pid`` in ``directory`` into
+    those of the processes which died before, and remove its files.
+
+    It must be called once the process exited (e.g., from the master
+    process of a pre-fork server), as the process writes its metrics when
+    it exits.
+
+    .. versionadded:: 1.1
+
+    """
+    dead_processes_path = os.path.join(directory, _DEAD_PROCESSES_FILE)
+    lock_fd = os.open(os.path.join(directory, _LOCK_FILE),
+                      os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.lockf(lock_fd, fcntl.LOCK_EX)
+        paths = glob(os.path.join(directory, '%s%d-*.json' %
+                                  (_FILE_PREFIX, pid)))
+        if not paths:
+            return
+        state = _merge([dead_processes_path] + paths)
+        _write_atomically(dead_processes_path, json.dumps(state))
+        for path in paths:
+            os.remove(path)
+    finally:
+        os.close(lock_fd)
+
+
+def _merge(paths):
+    """Return the merged metrics in the files at ``paths``."""
+    histograms = {}
+    counters = {}
+    for path in paths:
+        try:
+            with open(path) as metrics_file:
+                state = json.load(metrics_file)
+        except (IOError, OSError, ValueError):
+            # The process may have been removing it.
+            continue
+        for (name, branch, data) in state['histograms']:
+            histogram = _Histogram.from_dict(data)
+            key = (name, branch)
+            if key in histograms:
+                histograms[key].merge(histogram)
+            else:
+                histograms[key] = histogram
+        for (name, branch, value) in state['counters']:
+            counters[(name, branch)] = counters.get((name, branch), 0) + value
+    return {
+        'histograms': [[name, branch, histogram.to_dict()]
+                       for ((name, branch), histogram) in histograms.items()],
+        'counters': [[name, branch, value]
+                     for ((name, branch), value) in counters.items()],
+        }
+
+
+def render(state):
+    """Return the metrics in ``state`` in the Prometheus text format."""
+    histograms = {}
+    for (name, branch, data) in state['histograms']:
+        histograms.setdefault(name, []).append((branch, data))
+    counters = {}
+    for (name, branch, value) in state['counters']:
+        counters.setdefault(name, []).append((branch, value))
+
+    lines = []
+    for (name, metric_type, help_text) in _METRICS:
+        samples = histograms.get(name) or counters.get(name)
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for (branch, data) in sorted(samples, key=lambda sample: sample[0]):
+            if metric_type == 'counter':
+                lines.append('%s%s %s' % (name, _labels(branch), data))
+                continue
+            cumulative_count = 0
+            for (bound, count) in zip(data['buckets'], data['counts']):
+                cumulative_count += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(branch, le=_format_float(bound)),
+                    cumulative_count))
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(branch, le='+Inf'), data['count']))
+            lines.append('%s_sum%s %r' % (name, _labels(branch),
+                                          data['sum']))
+            lines.append('%s_count%s %d' % (name, _labels(branch),
+                                            data['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(directory, path):
+    """Merge the metrics in ``directory`` and write them to ``path``."""
+    _write_atomically(path, render(collect(directory)))
+
+
+def main(argv=None):
+    """Merge the metrics of all the workers and print or write them."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) not in (1, 2):
+        sys.stderr.write('Usage: python -m %s DIRECTORY [OUTPUT]\n' %
+                         __name__)
+        return 2
+    if len(argv) == 2:
+        write_textfile(argv[0], argv[1])
+    else:
+        sys.stdout.write(render(collect(argv[0])))
+    return 0
+
+
+class _Histogram(object):
+    """Histogram with fixed upper bounds, stored non-cumulatively."""
+
+    def __init__(self, buckets, counts=None, total=0.0, count=0):
+        self.buckets = buckets
+        self.counts = counts or [0] * len(buckets)
+        self.sum = total
+        self.count = count
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        if self.buckets != other.buckets:
+            raise ValueError('Cannot merge histograms with different buckets')
+        self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts),
+                'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(tuple(data['buckets']), list(data['counts']), data['sum'],
+                   data['count'])
+
+
+def _labels(branch, **extra):
+    labels = []
+    if branch:
+        labels.append('branch="%s"' % branch)
+    for (name, value) in sorted(extra.items()):
+        labels.append('%s="%s"' % (name, value))
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(labels)
+
+
+def _format_float(value):
+    if float(value) == int(value):
+        return '%d' % value
+    return repr(float(value))
+
+
+def _write_atomically(path, text):
+    temporary_path = '%s.%d-%d.tmp' % (path, os.getpid(), get_ident())
+    with open(temporary_path, 'w') as output:
+        output.write(text)
+    os.rename(temporary_path, path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
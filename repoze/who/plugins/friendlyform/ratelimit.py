@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Rate limiting of the login attempts received by
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`.
+
+"""
+
+from collections import OrderedDict
+from math import ceil
+from threading import Lock
+from time import time
+
+__all__ = ['LoginRateLimiter', 'SlidingWindowCounter']
+
+
+class LoginRateLimiter(object):
+    """
+    Limit the login attempts by client address and by submitted login.
+
+    :param address_limit: The maximum amount of login attempts from a given
+        client address within the ``window``.
+    :type address_limit: :class:`int`
+    :param login_limit: The maximum amount of attempts to log in as a given
+        user within the ``window``.
+    :type login_limit: :class:`int`
+    :param window: The length of the window, in seconds.
+    :type window: :class:`float`
+    :param max_entries: The maximum amount of addresses and logins to be
+        tracked (each).
+    :type max_entries: :class:`int`
+    :param address_key: The environ key with the client address; it could
+        be set by a trusted proxy.
+    :type address_key: :class:`str`
+
+    Either limit may be ``None`` to disable it.
+
+    """
+
+    def __init__(self, address_limit=20, login_limit=5, window=60,
+                 max_entries=100000, address_key='REMOTE_ADDR'):
+        self.address_key = address_key
+        if address_limit is None:
+            self.addresses = None
+        else:
+            self.addresses = SlidingWindowCounter(address_limit, window,
+                                                  max_entries)
+        if login_limit is None:
+            self.logins = None
+        else:
+            self.logins = SlidingWindowCounter(login_limit, window,
+                                               max_entries)
+
+    def check_address(self, environ):
+        """
+        Count an attempt from the client address in the ``environ``.
+
+        Return the amount of seconds to wait before retrying if the limit was
+        exceeded, or ``None`` otherwise.
+
+        """
+        if self.addresses is None:
+            return None
+        return self.addresses.hit(environ.get(self.address_key, ''))
+
+    def check_login(self, login):
+        """
+        Count an attempt to log in as ``login``.
+
+        Return the amount of seconds to wait before retrying if the limit was
+        exceeded, or ``None`` otherwise.
+
+        """
+        if self.logins is None:
+            return None
+        # Very long logins are truncated, as they are just a key:
+        return self.logins.hit(login[:256])
+
+
+class SlidingWindowCounter(object):
+    """
+    Size-bounded table of sliding window counters.
+
+    Each key keeps the hits in the current and the previous fixed window, and
+    the hits in the sliding window are estimated by weighting the latter with
+    the part of it which is still covered. So checks are O(1), and entries are
+    kept in least recently used order so the stale ones (two windows old) are
+    evicted from the front of the table in O(1) amortized time.
+
+    """
+
+    def __init__(self, limit, window, max_entries, clock=time):
+        self.limit = limit
+        self.window = float(window)
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def hit(self, key):
+        """
+        Count a hit for ``key``, unless it's over the limit.
+
+        Return the amount of seconds to wait before retrying if the limit was
+        exceeded, or ``None`` otherwise.
+
+        """
+        now = self._clock()
+        window_index = int(now // self.window)
+        with self._lock:
+            self._evict(now)
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                entry = [window_index, 0, 0, now]
+            else:
+                if window_index == entry[0] + 1:
+                    entry[2] = entry[1]
+                    entry[1] = 0
+                elif window_index != entry[0]:
+                    entry[1] = entry[2] = 0
+                entry[0] = window_index
+                entry[3] = now
+            # Re-inserting the entry moves it to the end of the table:
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            elapsed = (now % self.window) / self.window
+            hits = entry[2] * (1 - elapsed) + entry[1]
+            if hits + 1 > self.limit:
+                return max(int(ceil(self.window - now % self.window)), 1)
+            entry[1] += 1
+            return None
+
+    def _evict(self, now):
+        """Remove the entries which have not been hit in two windows."""
+        entries = self._entries
+        deadline = now - 2 * self.window
+        while entries:
+            (key, entry) = next(iter(entries.items()))
+            if entry[3] > deadline:
+                break
+            del entries[key]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Allowlist of the URLs which
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin` may redirect to
+after login and logout, to prevent open redirections through ``came_from``
+and the ``Referer`` header.
+
+"""
+
+from posixpath import normpath
+from urllib.parse import unquote, urlsplit
+
+__all__ = ['RedirectAllowlist']
+
+
+_SCHEMES = frozenset(['', 'http', 'https'])
+
+# Characters stripped by browsers from the ends of URLs:
+_URL_PADDING = ''.join(chr(code) for code in range(0x21))
+
+# Characters which, after a leading slash, may turn a path into a URL with a
+# host name (e.g., "//example.org" or "/\\example.org"):
+_SLASHES = frozenset(['/', '\\', '\t', '\n', '\r'])
+
+
+class RedirectAllowlist(object):
+    """
+    Allowlist of redirect targets, compiled from ``patterns`` such as:
+
+    * ``example.org``: Any URL on the host ``example.org``.
+    * ``*.example.org``: Any URL on the subdomains of ``example.org`` (at
+      any depth), but not on ``example.org`` itself.
+    * ``example.org/app``: Any URL on ``example.org`` whose path is
+      ``/app`` or is under it (e.g., ``/app/``, ``/app/page``).
+      Wildcard hosts may have paths too.
+
+    Host names are compared case-insensitively and ports are ignored. Only
+    HTTP(S) URLs may be allowed. URLs without a host name (i.e., paths) and
+    URLs on the host of the request itself are always allowed.
+
+    The patterns are stored in a trie of the labels of the host names, from
+    the top-level domain down, so checking a URL takes time proportional to
+    the length of its host name, however many patterns there are.
+
+    :param patterns: The patterns of the allowed URLs.
+    :type patterns: iterable
+
+    .. versionadded:: 1.1
+
+    """
+
+    def __init__(self, patterns):
+        self._root = _Node()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """Allow the URLs matching ``pattern``."""
+        (host, slash, path) = pattern.strip().partition('/')
+        host = _get_host_name(host)
+        if slash:
+            path = _normalize_path(slash + path)
+        labels = host.split('.')
+        is_wildcard = labels[0] == '*'
+        if is_wildcard:
+            labels.pop(0)
+        if not labels or '*' in labels or '' in labels:
+            raise ValueError('Invalid redirect pattern: %r' % pattern)
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.setdefault(label, _Node())
+        if is_wildcard:
+            node.subdomain_paths = _add_path(node.subdomain_paths, path)
+        else:
+            node.paths = _add_path(node.paths, path)
+
+    def is_allowed(self, url, request_host=None):
+        """
+        Return whether the redirection to ``url`` is allowed, on a request
+        made to ``request_host`` (its ``Host`` header).
+
+        The URL is taken like browsers do: Surrounding spaces, as well as
+        tabs and new lines, are ignored and backslashes are taken as slashes.
+
+        """
+        url = url.strip(_URL_PADDING)
+        if url[:1] == '/' and url[1:2] not in _SLASHES:
+            # A path on the same host, by far the most common destination.
+            return True
+        url = url.replace('\\', '/')
+        for character in '\t\n\r':
+            url = url.replace(character, '')
+        try:
+            url_parts = urlsplit(url)
+            host = url_parts.hostname
+        except ValueError:
+            return False
+        if url_parts.scheme.lower() not in _SCHEMES:
+            return False
+        if not url_parts.netloc:
+            # A relative URL, unless it's like "http:example.org".
+            return not url_parts.scheme
+        if not host:
+            return False
+        host = host.rstrip('.')
+        if request_host and host == _get_host_name(request_host):
+            return True
+        return self._match(host, url_parts.path)
+
+    def _match(self, host, path):
+        labels = host.split('.')
+        node = self._root
+        normalized_path = None
+        for index in range(len(labels) - 1, -1, -1):
+            node = node.children.get(labels[index])
+            if node is None:
+                return False
+            if node.subdomain_paths is not None and index:
+                # There are more labels, so the host is a subdomain.
+                if normalized_path is None:
+                    normalized_path = _normalize_path(path)
+                if _match_path(node.subdomain_paths, normalized_path):
+                    return True
+        if node.paths is None:
+            return False
+        if normalized_path is None:
+            normalized_path = _normalize_path(path)
+        return _match_path(node.paths, normalized_path)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+class _Node(object):
+    """
+    Label of a host name in the trie of patterns.
+
+    ``paths`` are the path prefixes allowed on the host name which ends with
+    this label (``''`` allows any path), and ``subdomain_paths`` the ones
+    allowed on its subdomains. They are ``None`` if there are none.
+
+    """
+
+    __slots__ = ('children', 'paths', 'subdomain_paths')
+
+    def __init__(self):
+        self.children = {}
+        self.paths = None
+        self.subdomain_paths = None
+
+
+def _add_path(paths, path):
+    if paths is None:
+        return (path, )
+    if '' in paths or path in paths:
+        return paths
+    if not path:
+        return ('', )
+    return paths + (path, )
+
+
+def _match_path(paths, path):
+    for prefix in paths:
+        if not prefix or path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def _normalize_path(path):
+    """
+    Return ``path`` decoded and without dot segments, like browsers and
+    servers interpret it, and without the trailing slash.
+
+    """
+    path = normpath('/' + unquote(path)).lstrip('/')
+    return path and '/' + path
+
+
+def _get_host_name(host):
+    """Return the ``host`` name, without the port."""
+    if host.startswith('['):
+        # An IPv6 address.
+        host = host[1:host.find(']')]
+    elif ':' in host:
+        host = host.rpartition(':')[0]
+    return host.lower().rstrip('.')
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Recording of real traffic and load testing of
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin` with it.
+
+:class:`TrafficRecorder` is a WSGI middleware which writes an anonymized
+record of every request (or of a sample of them) to a JSON lines file, and
+the ``friendlyform-replay`` command replays the records through the
+:meth:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin.identify` and
+:meth:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin.challenge`
+methods of a plugin, in this process or in several ones::
+
+    friendlyform-replay traffic.jsonl --config who.ini --processes 4
+
+It reports the throughput, the latency percentiles and the calls and
+latencies by branch of the plugin, so a new release can be checked against
+the shape of the production traffic before it's rolled out.
+
+The recorder wraps the :mod:`repoze.who` middleware, so that it sees the
+requests before the plugin changes them, and an
+:class:`ApplicationStatusRecorder` goes between that middleware and the
+application, so that the requests to be challenged are known::
+
+    app = TrafficRecorder(
+        PluggableAuthenticationMiddleware(ApplicationStatusRecorder(app),
+                                          ...),
+        '/var/log/traffic-%(pid)s.jsonl')
+
+Each record is a JSON object with the ``REQUEST_METHOD``, ``SCRIPT_NAME``,
+``PATH_INFO`` and ``QUERY_STRING`` of the request, its ``headers`` (a
+dictionary of environ keys like ``HTTP_HOST``), its ``body`` (decoded as
+Latin-1, if it was recorded) and the ``status`` code of the response of the
+application (or of the response sent, if the application was not called or
+there's no :class:`ApplicationStatusRecorder`).
+
+"""
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import sys
+from argparse import ArgumentParser
+from importlib import import_module
+from io import BytesIO
+from random import random
+from threading import Lock
+from time import perf_counter
+
+from repoze.who.plugins.friendlyform import FriendlyFormPlugin
+from repoze.who.plugins.friendlyform.asgi import AsyncFriendlyFormPlugin
+
+__all__ = ['TrafficRecorder', 'ApplicationStatusRecorder', 'load_records', 'make_environ', 'replay',
+           'format_report', 'main']
+
+
+_BODY_METHODS = frozenset(['POST', 'PUT', 'PATCH', 'DELETE'])
+
+_URLENCODED = 'application/x-www-form-urlencoded'
+
+_PERCENTILES = (50, 90, 99)
+
+#: The replacement of the values masked in the records.
+MASK = 'xxxxxxxx'
+
+# The environ key of the record of the request being recorded:
+_RECORD_KEY = 'repoze.who.plugins.friendlyform.record'
+
+
+class TrafficRecorder(object):
+    """
+    WSGI middleware which records the requests to the wrapped ``app`` in the
+    JSON lines file at ``path``.
+
+    The records are anonymized: The values of the variables in the query
+    string and in URL-encoded bodies are replaced with :data:`MASK`, except
+    for those in ``kept_variables``, and so are the values of the cookies
+    and the path and query string of the ``Referer`` header. Only the
+    headers in ``kept_headers``, the ``Cookie`` header and the ``Referer``
+    header are recorded. Other bodies are replaced entirely. The mask has a
+    fixed width, so the length of the values is not recorded either.
+
+    The ``path`` may contain ``%(pid)s``, which is replaced with the process
+    identifier, so that each worker of a pre-fork server writes its own file.
+
+    :param app: The WSGI application to be wrapped (i.e., the
+        :mod:`repoze.who` middleware).
+    :param path: The path to the file where the records are appended.
+    :type path: :class:`str`
+    :param sample_rate: The fraction of the requests to be recorded.
+    :type sample_rate: :class:`float`
+    :param kept_variables: The names of the variables whose value is
+        recorded as is, like the login counter.
+    :type kept_variables: iterable
+    :param kept_headers: The environ keys of the headers recorded as is.
+    :type kept_headers: iterable
+    :param max_body: The size of the largest body to be recorded. Only the
+        length of larger bodies is recorded.
+    :type max_body: :class:`int`
+
+    .. versionadded:: 1.1
+
+    """
+
+    def __init__(self, app, path, sample_rate=1.0,
+                 kept_variables=('__logins', ),
+                 kept_headers=('HTTP_HOST', 'CONTENT_TYPE', 'CONTENT_LENGTH',
+                               'HTTP_ACCEPT', 'HTTP_ACCEPT_LANGUAGE'),
+                 max_body=65536):
+        self.app = app
+        self.path = path
+        self.sample_rate = sample_rate
+        self.kept_variables = frozenset(kept_variables)
+        self.kept_headers = frozenset(kept_headers)
+        self.max_body = max_body
+        self._file = None
+        self._pid = None
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            return self.app(environ, start_response)
+        record = self._make_record(environ)
+        environ[_RECORD_KEY] = record
+
+        def recording_start_response(status, headers, exc_info=None):
+            if environ.pop(_RECORD_KEY, None) is not None:
+                # The status of the application takes precedence, if it was
+                # recorded by an ApplicationStatusRecorder:
+                record.setdefault('status', _get_status_code(status))
+                self._write(record)
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, recording_start_response)
+
+    def _make_record(self, environ):
+        """
+        Return the anonymized record of the request in the ``environ``,
+        whose body is buffered if it's recorded.
+
+        """
+        headers = {}
+        for (key, value) in environ.items():
+            if key in self.kept_headers:
+                headers[key] = value
+        if 'HTTP_COOKIE' in environ:
+            headers['HTTP_COOKIE'] = _mask_cookies(environ['HTTP_COOKIE'])
+        if 'HTTP_REFERER' in environ:
+            headers['HTTP_REFERER'] = _mask_url(environ['HTTP_REFERER'],
+                                                self.kept_variables)
+        record = {
+            'REQUEST_METHOD': environ.get('REQUEST_METHOD', 'GET'),
+            'SCRIPT_NAME': environ.get('SCRIPT_NAME', ''),
+            'PATH_INFO': environ.get('PATH_INFO', ''),
+            'QUERY_STRING': _mask_variables(environ.get('QUERY_STRING', ''),
+                                            self.kept_variables),
+            'headers': headers,
+            'body': None,
+            }
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if (record['REQUEST_METHOD'] in _BODY_METHODS and
+            0 < length <= self.max_body):
+            body = environ['wsgi.input'].read(length)
+            environ['wsgi.input'] = BytesIO(body)
+            body = body.decode('latin-1')
+            if environ.get('CONTENT_TYPE', '').startswith(_URLENCODED):
+                record['body'] = _mask_variables(body, self.kept_variables)
+            else:
+                record['body'] = MASK
+        return record
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            pid = os.getpid()
+            if self._pid != pid:
+                # This is a new process (e.g., a forked worker).
+                self._file = open(self.path % {'pid': pid}, 'a')
+                self._pid = pid
+            self._file.write(line)
+            self._file.flush()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+class ApplicationStatusRecorder(object):
+    """
+    WSGI middleware which records the status of the response of the wrapped
+    ``app`` in the record of the request made by :class:`TrafficRecorder`.
+
+    It must go between the :mod:`repoze.who` middleware and the application:
+    That middleware replaces the "401 Unauthorized" responses of the
+    application with the one returned by the challenger, so the recorder
+    wrapping it would only see the redirection to the login form, and the
+    replay could not tell which requests to challenge.
+
+    :param app: The WSGI application to be wrapped.
+
+    .. versionadded:: 1.1
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        record = environ.get(_RECORD_KEY)
+        if record is None:
+            # The request is not being recorded.
+            return self.app(environ, start_response)
+
+        def recording_start_response(status, headers, exc_info=None):
+            record['status'] = _get_status_code(status)
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, recording_start_response)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+def _get_status_code(status):
+    """Return the code in the WSGI ``status`` line as an integer."""
+    return int(status.split(' ', 1)[0])
+
+
+def _mask_variables(query_string, kept_variables):
+    """
+    Return the raw ``query_string`` with the values of the variables other
+    than ``kept_variables`` masked.
+
+    """
+    pairs = []
+    for pair in query_string.split('&'):
+        (name, equals, value) = pair.partition('=')
+        if name not in kept_variables:
+            value = _mask(value)
+        pairs.append(name + equals + value)
+    return '&'.join(pairs)
+
+
+def _mask_cookies(cookies):
+    """Return the ``Cookie`` header with the values of the cookies masked."""
+    masked_cookies = []
+    for cookie in cookies.split(';'):
+        (name, equals, value) = cookie.partition('=')
+        masked_cookies.append(name + equals + _mask(value))
+    return ';'.join(masked_cookies)
+
+
+def _mask_url(url, kept_variables):
+    """Return the ``url`` with its path and query string masked."""
+    (base, question_mark, query_string) = url.partition('?')
+    (scheme, separator, rest) = base.partition('://')
+    if separator:
+        (host, slash, path) = rest.partition('/')
+        base = scheme + separator + host + slash + _mask(path)
+    else:
+        base = _mask(base)
+    if question_mark:
+        base += '?' + _mask_variables(query_string, kept_variables)
+    return base
+
+
+def _mask(value):
+    """Return :data:`MASK`, or the ``value`` if it's empty."""
+    return MASK if value else value
+
+
+def load_records(path):
+    """Return the records in the JSON lines file at ``path``."""
+    with open(path) as records_file:
+        return [json.loads(line) for line in records_file if line.strip()]
+
+
+def make_environ(record):
+    """Return a new WSGI environ for the request in the ``record``."""
+    body = (record.get('body') or '').encode('latin-1')
+    environ = {
+        'REQUEST_METHOD': record.get('REQUEST_METHOD', 'GET'),
+        'SCRIPT_NAME': record.get('SCRIPT_NAME', ''),
+        'PATH_INFO': record['PATH_INFO'],
+        'QUERY_STRING': record.get('QUERY_STRING', ''),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(body),
+        }
+    environ.update(record.get('headers', {}))
+    if body:
+        # The recorded Content-Length is the one of the original body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class _BranchTimer(object):
+    """Observer of the plugin which keeps the latencies by branch."""
+
+    def __init__(self):
+        self.durations = {}
+
+    def identified(self, branch, duration, credentials):
+        self.durations.setdefault('identify.' + branch, []).append(duration)
+
+    def challenged(self, branch, duration, logins):
+        self.durations.setdefault('challenge.' + branch, []).append(duration)
+
+
+def _replay_records(plugin, records, repeat):
+    """
+    Replay the ``records`` through the ``plugin`` ``repeat`` times and return
+    the amount of requests, the time it took, the latency of each request
+    and the latencies by branch.
+
+    Like the :mod:`repoze.who` middleware, the plugin is asked to challenge
+    the requests answered with "401 Unauthorized", either by the
+    application or by the plugin itself (on logout).
+
+    The ``plugin`` may be any of the plugins in this package. The WSGI
+    plugin wrapped by an
+    :class:`~repoze.who.plugins.friendlyform.asgi.AsyncFriendlyFormPlugin`
+    is replayed instead of it.
+
+    """
+    if isinstance(plugin, AsyncFriendlyFormPlugin):
+        plugin = plugin.plugin
+    timer = _BranchTimer()
+    plugin.add_observer(timer)
+    try:
+        identify = plugin.identify
+        challenge = plugin.challenge
+        latencies = []
+        elapsed = 0
+        for iteration in range(repeat):
+            environs = [(make_environ(record), record.get('status'))
+                        for record in records]
+            start = perf_counter()
+            for (environ, status) in environs:
+                request_start = perf_counter()
+                identify(environ)
+                app = environ.get('repoze.who.application')
+                if ((app is None and status == 401) or
+                    getattr(app, 'code', None) == 401):
+                    challenge(environ, '401 Unauthorized', [], [])
+                latencies.append(perf_counter() - request_start)
+            elapsed += perf_counter() - start
+    finally:
+        plugin.remove_observer(timer)
+    return (len(latencies), elapsed, latencies, timer.durations)
+
+
+def _make_plugin(config=None, plugin_name=None, factory=None):
+    """
+    Return the plugin built by the ``factory`` (a ``module:callable``
+    string), or the one defined in the :mod:`repoze.who` ``config`` file,
+    or a plugin with the default settings.
+
+    """
+    if factory:
+        (module_name, attribute) = factory.split(':', 1)
+        return getattr(import_module(module_name), attribute)()
+    if config:
+        from repoze.who.config import WhoConfig
+        who_config = WhoConfig(os.path.dirname(os.path.abspath(config)))
+        with open(config) as config_file:
+            who_config.parse(config_file)
+        if plugin_name:
+            return who_config.plugins[plugin_name]
+        for plugin in who_config.plugins.values():
+            if isinstance(plugin, FriendlyFormPlugin):
+                return plugin
+        raise ValueError('There is no FriendlyFormPlugin in %s' % config)
+    return FriendlyFormPlugin('/login', '/login_handler', None,
+                              '/logout_handler', None, 'auth_tkt')
+
+
+def _replay_in_process(plugin_spec, records, repeat, barrier, results):
+    plugin = _make_plugin(**plugin_spec)
+    barrier.wait()
+    results.put(_replay_records(plugin, records, repeat))
+
+
+def replay(records, repeat=1, processes=1, **plugin_spec):
+    """
+    Replay the ``records`` ``repeat`` times through the plugin described by
+    ``plugin_spec`` (the ``config``, ``plugin_name`` or ``factory`` keyword
+    arguments) and return the report.
+
+    With more than one process, the records are split among them and each
+    process builds its own plugin.
+
+    The report is a dictionary with the amount of ``requests``, the
+    ``throughput`` (in requests per second), the ``latency`` percentiles (in
+    seconds) and the ``branches`` of the plugin, with their ``calls`` and
+    latency percentiles.
+
+    """
+    if processes <= 1:
+        results = [_replay_records(_make_plugin(**plugin_spec), records,
+                                   repeat)]
+    else:
+        barrier = multiprocessing.Barrier(processes)
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_replay_in_process,
+            args=(plugin_spec, records[index::processes], repeat, barrier,
+                  queue))
+                   for index in range(processes)]
+        for worker in workers:
+            worker.start()
+        results = [queue.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+
+    requests = 0
+    latencies = []
+    branches = {}
+    for (worker_requests, elapsed, worker_latencies, durations) in results:
+        requests += worker_requests
+        latencies.extend(worker_latencies)
+        for (branch, branch_durations) in durations.items():
+            branches.setdefault(branch, []).extend(branch_durations)
+    elapsed = max(result[1] for result in results)
+    return {
+        'requests': requests,
+        'processes': max(processes, 1),
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'latency': _get_percentiles(latencies),
+        'branches': dict((branch, dict(_get_percentiles(durations),
+                                       calls=len(durations)))
+                         for (branch, durations) in branches.items()),
+        }
+
+
+def _get_percentiles(durations):
+    durations = sorted(durations)
+    percentiles = {}
+    for percentile in _PERCENTILES:
+        if durations:
+            index = max(int(len(durations) * percentile / 100.0 + 0.5), 1)
+            percentiles['p%d' % percentile] = durations[index - 1]
+        else:
+            percentiles['p%d' % percentile] = 0.0
+    percentiles['max'] = durations[-1] if durations else 0.0
+    return percentiles
+
+
+def format_report(report):
+    """Return the ``report`` returned by :func:`replay` as text."""
+    names = ['p%d' % percentile for percentile in _PERCENTILES] + ['max']
+    lines = [
+        '%d requests in %d process(es): %.0f requests/s' % (
+            report['requests'], report['processes'], report['throughput']),
+        '%-32s %9s %s' % ('', 'calls', ' '.join('%9s' % name
+                                                for name in names)),
+        ]
+    rows = [('all requests', report['requests'], report['latency'])]
+    rows.extend((branch, stats['calls'], stats)
+                for (branch, stats) in sorted(report['branches'].items()))
+    for (name, calls, stats) in rows:
+        lines.append('%-32s %9d %s' % (name, calls, ' '.join(
+            '%7.1fus' % (stats[percentile] * 1e6) for percentile in names)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Replay the recorded traffic through the plugin."""
+    parser = ArgumentParser(
+        description='Replay recorded WSGI requests through FriendlyFormPlugin')
+    parser.add_argument('records', help='JSON lines file with the requests')
+    parser.add_argument('--config',
+                        help='repoze.who INI file with the plugin')
+    parser.add_argument('--plugin', dest='plugin_name',
+                        help='name of the plugin in the INI file')
+    parser.add_argument('--factory',
+                        help='module:callable which returns the plugin')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='times each record is replayed')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='processes the records are split among')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    options = parser.parse_args(argv)
+    records = load_records(options.records)
+    if not records:
+        parser.error('%s has no records' % options.records)
+    report = replay(records, options.repeat, options.processes,
+                    config=options.config, plugin_name=options.plugin_name,
+                    factory=options.factory)
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2009-2010, Gustavo Narea <me@gustavonarea.net> and contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Multi-tenant version of
+:class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`, for sites which
+serve many tenants (each on its own host name) from the same WSGI stack.
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from zope.interface import implementer
+
+from repoze.who.interfaces import IChallenger, IIdentifier
+
+from repoze.who.plugins.friendlyform import FriendlyFormPlugin
+
+__all__ = ['TenantFriendlyFormPlugin']
+
+
+_TENANT_KEY = 'repoze.who.plugins.friendlyform.tenant'
+
+
+@implementer(IChallenger, IIdentifier)
+class TenantFriendlyFormPlugin(object):
+    """
+    Form plugin which delegates each request to the
+    :class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin` of its
+    tenant.
+
+    The tenant is identified by the value of the ``tenant_key`` item in the
+    environ (the host name, by default) and its configuration is looked up in
+    ``tenants``, which may be a dictionary or a callable returning it (e.g.,
+    from a database). Configurations are dictionaries with the arguments for
+    :class:`~repoze.who.plugins.friendlyform.FriendlyFormPlugin`, which
+    override the ``defaults``, or ``None`` for unknown tenants.
+
+    The plugins of the tenants are built on their first request and kept in a
+    least recently used cache of at most ``max_tenants`` items, so memory
+    usage depends on the amount of active tenants. Unknown tenants are kept
+    in the cache too, for ``unknown_tenant_ttl`` seconds, so requests with a
+    forged host name don't make the tenants be looked up every time.
+
+    Requests from unknown tenants are neither identified nor challenged.
+
+    :param tenants: The configurations of the tenants.
+    :type tenants: :class:`dict` or callable
+    :param max_tenants: The maximum amount of plugins to be kept.
+    :type max_tenants: :class:`int`
+    :param tenant_key: The environ key which identifies the tenant. If it's
+        ``HTTP_HOST``, the port is ignored and the host name is lower-cased.
+    :type tenant_key: :class:`str`
+    :param unknown_tenant_ttl: The amount of seconds unknown tenants are
+        cached for (``0`` to look them up on every request).
+    :type unknown_tenant_ttl: :class:`float`
+
+    .. versionadded:: 1.1
+
+    """
+    classifications = {
+        IIdentifier: ["browser"],
+        IChallenger: ["browser"],
+        }
+
+    def __init__(self, tenants, max_tenants=1024, tenant_key='HTTP_HOST',
+                 unknown_tenant_ttl=60, **defaults):
+        if callable(tenants):
+            self._load_tenant = tenants
+        else:
+            self._load_tenant = tenants.get
+        self.max_tenants = max_tenants
+        self.tenant_key = tenant_key
+        self.unknown_tenant_ttl = unknown_tenant_ttl
+        self.defaults = defaults
+        self._plugins = OrderedDict()
+        self._observers = ()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unknown = 0
+
+    # IIdentifier
+    def identify(self, environ):
+        plugin = self._get_plugin(environ)
+        if plugin is None:
+            return None
+        return plugin.identify(environ)
+
+    # IChallenger
+    def challenge(self, environ, status, app_headers, forget_headers):
+        plugin = self._get_plugin(environ)
+        if plugin is None:
+            return None
+        return plugin.challenge(environ, status, app_headers, forget_headers)
+
+    # IIdentifier
+    def remember(self, environ, identity):
+        plugin = self._get_plugin(environ)
+        if plugin is None:
+            return None
+        return plugin.remember(environ, identity)
+
+    # IIdentifier
+    def forget(self, environ, identity):
+        plugin = self._get_plugin(environ)
+        if plugin is None:
+            return None
+        return plugin.forget(environ, identity)
+
+    def add_observer(self, observer):
+        """
+        Notify ``observer`` of every identification and challenge, in all the
+        tenants (see :meth:`FriendlyFormPlugin.add_observer
+        <repoze.who.plugins.friendlyform.FriendlyFormPlugin.add_observer>`).
+
+        """
+        with self._lock:
+            self._observers = self._observers + (observer, )
+            for plugin in self._get_cached_plugins():
+                plugin.add_observer(observer)
+
+    def remove_observer(self, observer):
+        """Stop notifying ``observer``, in all the tenants."""
+        with self._lock:
+            observers = list(self._observers)
+            observers.remove(observer)
+            self._observers = tuple(observers)
+            for plugin in self._get_cached_plugins():
+                plugin.remove_observer(observer)
+
+    def _get_cached_plugins(self):
+        return [plugin for plugin in self._plugins.values()
+                if plugin.__class__ is not _UnknownTenant]
+
+    def get_tenant_stats(self):
+        """
+        Return the statistics of the cache of plugins, in a dictionary with
+        the ``size``, ``hits``, ``misses``, ``evictions`` and ``unknown``
+        items; the latter being the amount of requests from unknown tenants.
+
+        """
+        with self._lock:
+            return {
+                'size': len(self._plugins),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'unknown': self.unknown,
+                }
+
+    def _get_plugin(self, environ):
+        """
+        Return the plugin of the tenant of the request, or ``None`` if it's
+        unknown.
+
+        It's stored in the ``environ``, so it's looked up once per request.
+
+        """
+        try:
+            return environ[_TENANT_KEY]
+        except KeyError:
+            pass
+        plugin = self._get_tenant_plugin(self._get_tenant(environ))
+        environ[_TENANT_KEY] = plugin
+        return plugin
+
+    def _get_tenant(self, environ):
+        tenant = environ.get(self.tenant_key, '')
+        if self.tenant_key == 'HTTP_HOST':
+            (host, sep, port) = tenant.rpartition(':')
+            if sep and port.isdigit():
+                tenant = host
+            tenant = tenant.lower()
+        return tenant
+
+    def _get_tenant_plugin(self, tenant):
+        """
+        Return the plugin of ``tenant``, building it if necessary, or ``None``
+        if it's unknown.
+
+        """
+        with self._lock:
+            try:
+                plugin = self._plugins[tenant]
+            except KeyError:
+                self.misses += 1
+            else:
+                if plugin.__class__ is not _UnknownTenant:
+                    self._plugins.move_to_end(tenant)
+                    self.hits += 1
+                    return plugin
+                if time() < plugin.expiration_time:
+                    self._plugins.move_to_end(tenant)
+                    self.hits += 1
+                    self.unknown += 1
+                    return None
+                # It may be known by now.
+                del self._plugins[tenant]
+                self.misses += 1
+
+        config = self._load_tenant(tenant)
+        if config is None:
+            if not self.unknown_tenant_ttl:
+                with self._lock:
+                    self.unknown += 1
+                return None
+            plugin = _UnknownTenant(time() + self.unknown_tenant_ttl)
+        else:
+            arguments = dict(self.defaults)
+            arguments.update(config)
+            plugin = FriendlyFormPlugin(**arguments)
+
+        with self._lock:
+            # Another thread may have built it meanwhile:
+            if tenant not in self._plugins:
+                if plugin.__class__ is not _UnknownTenant:
+                    for observer in self._observers:
+                        plugin.add_observer(observer)
+                self._plugins[tenant] = plugin
+            plugin = self._plugins[tenant]
+            if len(self._plugins) > self.max_tenants:
+                self._plugins.popitem(last=False)
+                self.evictions += 1
+            if plugin.__class__ is _UnknownTenant:
+                self.unknown += 1
+                return None
+        return plugin
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+class _UnknownTenant(object):
+    """Entry of an unknown tenant in the cache of plugins."""
+
+    __slots__ = ('expiration_time', )
+
+    def __init__(self, expiration_time):
+        self.expiration_time = expiration_time
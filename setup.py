@@ -32,6 +32,15 @@ setup(name='repoze.who-friendlyform',
         "Natural Language :: English",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
+        "Programming Language :: Python :: 3.13",
         "Topic :: Internet :: WWW/HTTP :: WSGI",
         "Topic :: Security"
         ],
@@ -44,9 +53,12 @@ setup(name='repoze.who-friendlyform',
       packages=find_packages(),
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.7',
       tests_require=['repoze.who >= 1.0', 'coverage', 'nose'],
       install_requires=['repoze.who >= 1.0', 'zope.interface', 'WebOb>=0.9.7'],
       test_suite='nose.collector',
       entry_points = """\
+      [console_scripts]
+      friendlyform-replay = repoze.who.plugins.friendlyform.replay:main
       """
       )